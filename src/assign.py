@@ -0,0 +1,143 @@
+import os
+import time
+import json
+import argparse
+import numpy as np
+import pandas as pd
+from flask import Flask, request, jsonify, abort
+from sklearn.neighbors import NearestNeighbors
+from utils import load_pickle, load_scaling, run_entry
+
+app = Flask(__name__)
+
+# Scaler, model and DBSCAN index of the served run, loaded once at startup
+assigner = {}
+
+def core_sample_index(model):
+    # DBSCAN has no predict: a new row joins the cluster of its nearest core sample if it lies within eps, else it is noise
+    if model.metric == "precomputed":
+        raise ValueError("DBSCAN fitted on a precomputed distance matrix cannot assign new rows")
+    core_labels = np.asarray(model.labels_)[model.core_sample_indices_]
+    if len(core_labels) == 0:
+        return None, core_labels
+    # Identical core samples always share a cluster, the index only needs one of each
+    components, first = np.unique(np.asarray(model.components_, dtype=np.float32), axis=0, return_index=True)
+    index = NearestNeighbors(n_neighbors=1, algorithm=model.algorithm, leaf_size=model.leaf_size, metric=model.metric, p=model.p, metric_params=model.metric_params)
+    index.fit(components)
+    return index, core_labels[first]
+
+def load_assigner(run_dir):
+    data_scaled, columns, scaler = load_scaling(run_entry(run_dir))
+    model = load_pickle(os.path.join(run_dir, "clustering_model.pkl"))
+    loaded = {
+        "run_dir": run_dir,
+        "columns": columns,
+        "scaler": scaler,
+        "model": model,
+        "index": None
+    }
+    if not hasattr(model, "predict"):
+        if not hasattr(model, "core_sample_indices_"):
+            raise ValueError(f"{type(model).__name__} has neither predict nor core samples, new rows cannot be assigned")
+        loaded["index"], loaded["core_labels"] = core_sample_index(model)
+        loaded["eps"] = model.eps
+
+    # One throwaway row so the first real batch does not pay for lazy initialisation
+    sample = np.asarray(data_scaled[:1], dtype=np.float64)
+    assign(loaded, pd.DataFrame(scaler.inverse_transform(sample) if scaler is not None else sample, columns=columns))
+    return loaded
+
+def assign(loaded, rows):
+    # Label each distinct row once (billing rows repeat a lot), scaled with the run's own scaler
+    start = time.perf_counter()
+    rows = rows[loaded["columns"]]
+    inverse, hashes = pd.factorize(pd.util.hash_pandas_object(rows, index=False))
+    distinct = rows.iloc[np.unique(inverse, return_index=True)[1]]
+    distinct = loaded["scaler"].transform(distinct) if loaded["scaler"] is not None else distinct.to_numpy()
+    distinct = np.asarray(distinct, dtype=np.float32)
+
+    if loaded["index"] is None and "core_labels" in loaded:
+        labels = np.full(len(distinct), -1, dtype=np.int32)
+    elif loaded["index"] is not None:
+        distances, nearest = loaded["index"].kneighbors(distinct)
+        labels = np.where(distances[:, 0] <= loaded["eps"], loaded["core_labels"][nearest[:, 0]], -1).astype(np.int32)
+    else:
+        labels = np.asarray(loaded["model"].predict(distinct), dtype=np.int32)
+    labels = labels[inverse]
+
+    seconds = time.perf_counter() - start
+    stats = {
+        "rows": len(rows),
+        "distinct_rows": len(distinct),
+        "seconds": seconds,
+        "rows_per_second": len(rows) / seconds if seconds > 0 else float("inf"),
+        "ms_per_1000_rows": 1e6 * seconds / max(len(rows), 1)
+    }
+    return labels, stats
+
+def assign_csv(run_dir, input_csv, output_csv, batch_rows=10000, stats_json=None):
+    loaded = load_assigner(run_dir)
+    batches = []
+    first = True
+    for batch in pd.read_csv(input_csv, chunksize=batch_rows):
+        labels, stats = assign(loaded, batch)
+        batch["Cluster"] = labels
+        batch.to_csv(output_csv, index=False, mode='w' if first else 'a', header=first)
+        first = False
+        batches.append(stats)
+        print(f"Assigned {stats['rows']} rows in {1000 * stats['seconds']:.1f} ms ({stats['ms_per_1000_rows']:.2f} ms per 1000 rows)")
+
+    rows, seconds = sum(s["rows"] for s in batches), sum(s["seconds"] for s in batches)
+    summary = {
+        "run_dir": run_dir,
+        "batches": batches,
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_second": rows / seconds if seconds > 0 else float("inf"),
+        "ms_per_1000_rows": 1e6 * seconds / max(rows, 1)
+    }
+    if stats_json:
+        with open(stats_json, 'w') as fp:
+            json.dump(summary, fp)
+    print(f"Labels saved to '{output_csv}': {rows} rows, {summary['ms_per_1000_rows']:.2f} ms per 1000 rows.")
+    return summary
+
+@app.route('/assign', methods=['POST'])
+def assign_rows():
+    # Body: {"rows": [{column: value, ...}, ...]} or {"columns": [...], "rows": [[...], ...]}
+    payload = request.get_json(silent=True)
+    if not payload or "rows" not in payload:
+        abort(400)
+    try:
+        rows = pd.DataFrame(payload["rows"], columns=payload.get("columns"))
+        labels, stats = assign(assigner, rows)
+    except KeyError as e:
+        return jsonify({"error": f"missing columns {e}"}), 400
+    stats["labels"] = labels.tolist()
+    return jsonify(stats)
+
+@app.route('/run')
+def run_info():
+    return jsonify({
+        "run_dir": assigner["run_dir"],
+        "model": type(assigner["model"]).__name__,
+        "columns": assigner["columns"]
+    })
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Assign new rows to the clusters of a saved run.')
+    parser.add_argument('--run_dir', type=str, help='Clustering run directory (clustering_model.pkl, scaling.json)')
+    parser.add_argument('--input_csv', type=str, help='CSV of new rows with the training columns, omit with --serve', default=None)
+    parser.add_argument('--output_csv', type=str, help='Input rows plus a Cluster column (default: <input_csv>_clusters.csv)', default=None)
+    parser.add_argument('--batch_rows', type=int, help='Rows per scoring batch', default=10000)
+    parser.add_argument('--stats_json', type=str, help='Save per-batch latency and throughput to this file', default=None)
+    parser.add_argument('--serve', action='store_true', help='Keep the model warm and serve POST /assign instead of scoring a file')
+    parser.add_argument('--port', type=int, help='Port of the assignment service', default=5001)
+    args = parser.parse_args()
+
+    if args.serve:
+        assigner.update(load_assigner(args.run_dir))
+        app.run(port=args.port)
+    else:
+        output_csv = args.output_csv or os.path.splitext(args.input_csv)[0] + "_clusters.csv"
+        assign_csv(args.run_dir, args.input_csv, output_csv, args.batch_rows, args.stats_json)
@@ -0,0 +1,218 @@
+import os
+import sys
+import shutil
+import platform
+import argparse
+import numpy as np
+import pandas as pd
+import sklearn
+from sklearn.neighbors import BallTree
+from sklearn.preprocessing import StandardScaler
+from utils import load_json, dump_json, StageTimer
+import train
+import eval as evaluation
+import pca
+import grid_search
+
+# Same columns as data/preprocessed_data_450.csv
+COLUMNS = ["JAMNYALA", "KWHLWBP", "KWHWBP", "BLOK3", "PEMKWH", "RPLWBP", "RPWBP", "RPBLOK3", "RPBEBAN", "RPPTL", "RPBPJU", "RPPLN", "RPTAG", "RPTAG_MAT", "RPREDUKSI", "RPANGS", "RPBK"]
+
+CONFIGS = {
+    "kmeans": {
+        "class_name": "sklearn.cluster.KMeans",
+        "hparams": {"n_clusters": 8},
+        "fit_params": {}
+    },
+    "dbscan": {
+        "class_name": "sklearn.cluster.DBSCAN",
+        # eps is calibrated per size, see dbscan_eps. With 17 features "auto" picks brute force, which is quadratic in the rows
+        "hparams": {"eps": None, "min_samples": 10, "algorithm": "ball_tree"},
+        "fit_params": {}
+    }
+}
+
+# Part of the cached CSV names, bumped whenever synthetic_data changes
+GENERATOR_VERSION = 2
+
+def synthetic_data(n_rows, seed=0, n_segments=6):
+    # 450 VA customers: monthly kWh drawn per usage segment, bill components derived from it with the real tariff blocks
+    rng = np.random.default_rng(seed)
+    segment = rng.integers(n_segments, size=n_rows)
+    mean_kwh = np.exp(np.linspace(3.0, 5.5, n_segments))[segment]
+    raw_kwh = np.minimum(rng.gamma(2.0, mean_kwh / 2.0), 1000)
+    pemkwh = np.round(raw_kwh).astype(np.int64)
+
+    kwhlwbp = np.minimum(pemkwh, 30)
+    kwhwbp = np.clip(pemkwh - 30, 0, 30)
+    blok3 = np.maximum(pemkwh - 60, 0)
+    rplwbp = 169.0 * kwhlwbp
+    rpwbp = 360.0 * kwhwbp
+    rpblok3 = 495.0 * blok3
+    rpbeban = np.full(n_rows, 4950.0)
+    rpptl = rplwbp + rpwbp + rpblok3 + rpbeban
+    # Street lighting tax only in some regions
+    rpbpju = np.where(rng.random(n_rows) < 0.15, np.round(rpptl * rng.choice([0.03, 0.06, 0.1], n_rows)), 0.0)
+    rptag = rpptl + rpbpju
+
+    return pd.DataFrame({
+        # Usage hours from the unrounded meter reading, otherwise rows only take a few thousand distinct values
+        "JAMNYALA": raw_kwh / 0.45,
+        "KWHLWBP": kwhlwbp,
+        "KWHWBP": kwhwbp,
+        "BLOK3": blok3,
+        "PEMKWH": pemkwh,
+        "RPLWBP": rplwbp,
+        "RPWBP": rpwbp,
+        "RPBLOK3": rpblok3,
+        "RPBEBAN": rpbeban,
+        "RPPTL": rpptl,
+        "RPBPJU": rpbpju,
+        "RPPLN": rpptl,
+        "RPTAG": rptag,
+        "RPTAG_MAT": rptag,
+        "RPREDUKSI": np.zeros(n_rows),
+        "RPANGS": (rng.random(n_rows) < 0.0056).astype(np.int64),
+        "RPBK": (rng.random(n_rows) < 0.95).astype(np.int64)
+    })[COLUMNS]
+
+def dbscan_eps(data, target, n_queries=500, seed=0):
+    # eps at which a standard-scaled row has about target neighbours, so DBSCAN grows linearly with the rows
+    features = StandardScaler().fit_transform(data)
+    tree = BallTree(features)
+    queries = features[np.random.default_rng(seed).choice(len(features), min(n_queries, len(features)), replace=False)]
+    low, high = 0.0, 1.0
+    for i in range(30):
+        eps = (low + high) / 2
+        if tree.query_radius(queries, eps, count_only=True).mean() > target:
+            high = eps
+        else:
+            low = eps
+    return low
+
+def synthetic_csv(n_rows, work_dir, seed=0):
+    # Generated once per size and seed, later runs reuse the file
+    path = os.path.join(work_dir, f"synthetic_{n_rows}_{seed}_v{GENERATOR_VERSION}.csv")
+    if not os.path.exists(path):
+        synthetic_data(n_rows, seed).to_csv(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+    return path
+
+def machine_info():
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "sklearn": sklearn.__version__
+    }
+
+def run_size(n_rows, work_dir, timer, dbscan_rows, silhouette_budget, plot_points, seed=0, dbscan_neighbors=20):
+    data_path = synthetic_csv(n_rows, work_dir, seed)
+    size_dir = os.path.join(work_dir, str(n_rows))
+    if os.path.exists(size_dir):
+        shutil.rmtree(size_dir)
+    os.makedirs(size_dir)
+
+    # A fixed eps would give neighbourhoods that grow with the rows, i.e. quadratic DBSCAN, so it is calibrated (untimed)
+    run_dbscan = dbscan_rows is None or n_rows <= dbscan_rows
+    eps = dbscan_eps(pd.read_csv(data_path), dbscan_neighbors, seed=seed) if run_dbscan else None
+
+    # Each stage of the standalone pipeline, once per estimator
+    for name, config in CONFIGS.items():
+        if name == "dbscan":
+            if not run_dbscan:
+                print(f"Skipping {name} on {n_rows} rows, above --dbscan_rows.")
+                continue
+            config = dict(config, hparams=dict(config["hparams"], eps=eps))
+        run_dir = os.path.join(size_dir, name)
+        os.makedirs(run_dir)
+        config_path = os.path.join(size_dir, f"{name}.json")
+        dump_json(config, config_path)
+
+        print(f"Benchmarking {name} on {n_rows} rows...")
+        with timer.stage(f"{n_rows}/train_{name}"):
+            train.cluster_data(config_path, "standard", data_path, run_dir)
+        with timer.stage(f"{n_rows}/eval_{name}"):
+            evaluation.evaluate_clustering(run_dir, run_dir, silhouette_budget)
+        with timer.stage(f"{n_rows}/pca_{name}"):
+            pca.perform_pca_run(run_dir, "Cluster", False, {}, run_dir, max_points=plot_points)
+
+    # The full grid search loop, in-process with a shared-work DBSCAN sweep
+    gs = {"gs": [{"class_name": "sklearn.cluster.KMeans", "hparams": {"n_clusters": [4, 8]}, "fit_params": {}}], "scaling": ["standard"]}
+    if run_dbscan:
+        gs["gs"].append({"class_name": "sklearn.cluster.DBSCAN", "hparams": {"eps": [eps / 2, eps], "min_samples": [10], "algorithm": ["ball_tree"]}, "fit_params": {}})
+    gs_path = os.path.join(size_dir, "gs.json")
+    dump_json(gs, gs_path)
+    print(f"Benchmarking grid search on {n_rows} rows...")
+    with timer.stage(f"{n_rows}/grid_search"):
+        grid_search.main(data_path, gs_path, os.path.join(size_dir, "gs"), sweep=True, cache_dir=os.path.join(size_dir, "cache"), overwrite=True, silhouette_budget=silhouette_budget, plot_points=plot_points)
+    return eps
+
+def best_of(runs):
+    # Fastest repeat per stage, the least disturbed by the rest of the machine
+    return {stage: min((run[stage] for run in runs if stage in run), key=lambda s: s["wall"]) for stage in runs[0]}
+
+def compare(results, baseline, threshold, min_seconds):
+    regressions = []
+    for stage, current in results.items():
+        if stage not in baseline:
+            continue
+        previous = baseline[stage]
+        # Below min_seconds a stage is all noise
+        if current["wall"] > max(previous["wall"], min_seconds) * (1 + threshold):
+            regressions.append((stage, "wall", previous["wall"], current["wall"]))
+        if current["peak_rss_mb"] > previous["peak_rss_mb"] * (1 + threshold):
+            regressions.append((stage, "peak_rss_mb", previous["peak_rss_mb"], current["peak_rss_mb"]))
+    return regressions
+
+def main(sizes=(10000, 100000, 1000000), out_path="../out/benchmark/results.json", baseline_path=None, threshold=0.2, min_seconds=0.5, repeat=1, dbscan_rows=None, silhouette_budget=10000, plot_points=20000, seed=0, dbscan_neighbors=20):
+    work_dir = os.path.dirname(os.path.abspath(out_path))
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    runs, eps_by_size = [], {}
+    for r in range(repeat):
+        timer = StageTimer()
+        for n_rows in sizes:
+            eps_by_size[n_rows] = run_size(n_rows, work_dir, timer, dbscan_rows, silhouette_budget, plot_points, seed, dbscan_neighbors)
+        runs.append(timer.stages)
+    results = best_of(runs)
+
+    dump_json({
+        "machine": machine_info(),
+        "settings": {"sizes": list(sizes), "repeat": repeat, "dbscan_rows": dbscan_rows, "dbscan_neighbors": dbscan_neighbors, "dbscan_eps": eps_by_size, "silhouette_budget": silhouette_budget, "plot_points": plot_points, "seed": seed},
+        "results": results
+    }, out_path)
+
+    print(f"{'stage':<32}{'wall (s)':>12}{'cpu (s)':>12}{'peak (MB)':>12}")
+    for stage, result in results.items():
+        print(f"{stage:<32}{result['wall']:>12.2f}{result['cpu']:>12.2f}{result['peak_rss_mb']:>12.0f}")
+    print("Saved in", out_path)
+
+    if baseline_path is None:
+        return 0
+    regressions = compare(results, load_json(baseline_path)["results"], threshold, min_seconds)
+    for stage, metric, previous, current in regressions:
+        print(f"Regression in {stage} {metric}: {previous:.2f} -> {current:.2f} ({current / previous - 1:+.0%})")
+    if not regressions:
+        print(f"No regression above {threshold:.0%} against", baseline_path)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark train, eval, PCA and grid search on synthetic tariff data.')
+    parser.add_argument('--sizes', type=int, nargs='+', help="Rows of the synthetic datasets.", default=[10000, 100000, 1000000])
+    parser.add_argument('--out', type=str, help="Results JSON file, synthetic data and runs are kept next to it.", default="../out/benchmark/results.json")
+    parser.add_argument('--baseline', type=str, help="Results JSON of an earlier run to compare against.", default=None)
+    parser.add_argument('--threshold', type=float, help="Relative slowdown or memory growth reported as a regression.", default=0.2)
+    parser.add_argument('--min_seconds', type=float, help="Wall times below this are too noisy to flag.", default=0.5)
+    parser.add_argument('--repeat', type=int, help="Repeat every size and keep the fastest run of each stage.", default=1)
+    parser.add_argument('--dbscan_rows', type=int, help="Skip DBSCAN above this many rows (default: run it at every size).", default=None)
+    parser.add_argument('--dbscan_neighbors', type=int, help="Average neighbourhood size the DBSCAN eps is calibrated to at every size.", default=20)
+    parser.add_argument('--silhouette_budget', type=int, help="Silhouette sample size used by eval and grid search.", default=10000)
+    parser.add_argument('--plot_points', type=int, help="Scatter plot downsampling used by PCA and grid search.", default=20000)
+    parser.add_argument('--seed', type=int, help="Seed of the synthetic data.", default=0)
+    args = parser.parse_args()
+
+    sys.exit(main(args.sizes, args.out, args.baseline, args.threshold, args.min_seconds, args.repeat, args.dbscan_rows, args.silhouette_budget, args.plot_points, args.seed, args.dbscan_neighbors))
@@ -1,57 +1,223 @@
 import os
 import json
 import argparse
-import pandas as pd
-from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.stats import norm
+from sklearn.metrics import silhouette_score, davies_bouldin_score, calinski_harabasz_score, pairwise_distances
 from sklearn.preprocessing import StandardScaler
-from utils import load_pickle
+from utils import load_pickle, load_run, read_dataset, stage, failed_score
 
-def evaluate_clustering(input_dir, output_dir):
-    # Load clustered data
-    clustered_data = pd.read_csv(os.path.join(input_dir, "data_with_clusters.csv"))
+def stratified_sample(cluster_ids, counts, budget, random_state=0):
+    # Proportional allocation per cluster, with at least two rows (or the whole cluster) each
+    rng = np.random.default_rng(random_state)
+    allocation = np.maximum(np.minimum(counts, 2), np.floor(budget * counts / counts.sum()).astype(int))
+    allocation = np.minimum(allocation, counts)
+    order = np.argsort(cluster_ids, kind="stable")
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sample = [rng.choice(order[start:start + count], size=size, replace=False) for start, count, size in zip(starts, counts, allocation)]
+    return np.sort(np.concatenate(sample))
 
-    # Extract cluster labels and features
-    cluster_labels = clustered_data['Cluster']
-    features = clustered_data.drop(columns=['Cluster'])
-    
-    # Load model
-    model = load_pickle(os.path.join(input_dir, "clustering_model.pkl"))
+def encode_labels(cluster_labels):
+    labels, cluster_ids, counts = np.unique(np.asarray(cluster_labels), return_inverse=True, return_counts=True)
+    n_samples, n_labels = len(cluster_ids), len(labels)
+    if not 1 < n_labels < n_samples:
+        raise ValueError(f"Number of labels is {n_labels}. Valid values are 2 to n_samples - 1 (inclusive)")
+    membership = csr_matrix((np.ones(n_samples), (np.arange(n_samples), cluster_ids)), shape=(n_samples, n_labels))
+    return cluster_ids, counts, membership
+
+def row_silhouettes(distances, rows, cluster_ids, counts, membership):
+    # distances holds every row's distance to the given rows, one column per row
+    cluster_sums = np.asarray((membership.T @ distances).T)
+    own = cluster_ids[rows]
+    intra = cluster_sums[np.arange(len(rows)), own] / np.maximum(counts[own] - 1, 1)
+    cluster_sums[np.arange(len(rows)), own] = np.inf
+    inter = (cluster_sums / counts).min(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        silhouette = np.nan_to_num((inter - intra) / np.maximum(intra, inter))
+    return np.where(counts[own] > 1, silhouette, 0)
+
+def sampled_silhouette(features, cluster_labels, budget, confidence=0.95, random_state=0, chunk_bytes=1 << 26):
+    features = np.asarray(features)
+    cluster_ids, counts, membership = encode_labels(cluster_labels)
+    n_samples, n_labels = len(cluster_ids), len(counts)
+
+    sample = stratified_sample(cluster_ids, counts, budget, random_state)
+
+    # Exact silhouette of every sampled row against all rows, streamed in bounded blocks
+    chunk_size = max(1, chunk_bytes // (8 * n_samples))
+    values = np.empty(len(sample))
+    for start in range(0, len(sample), chunk_size):
+        rows = sample[start:start + chunk_size]
+        distances = pairwise_distances(features, features[rows])
+        values[start:start + chunk_size] = row_silhouettes(distances, rows, cluster_ids, counts, membership)
+
+    # Stratified estimate of the mean and its variance, with finite population correction
+    sample_ids = cluster_ids[sample]
+    weights = counts / n_samples
+    sizes = np.bincount(sample_ids, minlength=n_labels)
+    means = np.bincount(sample_ids, weights=values, minlength=n_labels) / sizes
+    squares = np.bincount(sample_ids, weights=(values - means[sample_ids]) ** 2, minlength=n_labels)
+    variances = squares / np.maximum(sizes - 1, 1)
+    estimate = float(np.sum(weights * means))
+    error = float(norm.ppf(0.5 + confidence / 2) * np.sqrt(np.sum(weights ** 2 * variances / sizes * (1 - sizes / counts))))
+    return estimate, estimate - error, estimate + error, len(sample)
+
+def batch_metrics(features, label_sets, chunk_bytes=1 << 26):
+    # Exact scores for many labelings of the same features, one pass over pairwise distances
+    features = np.asarray(features)
+    n_samples = features.shape[0]
+
+    encoded, silhouette_sums = [], []
+    for cluster_labels in label_sets:
+        try:
+            encoded.append(encode_labels(cluster_labels))
+        except ValueError as e:
+            print("Error:", e)
+            encoded.append(None)
+        silhouette_sums.append(0.0)
+
+    chunk_size = max(1, chunk_bytes // (8 * n_samples))
+    if any(e is not None for e in encoded):
+        for start in range(0, n_samples, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, n_samples))
+            distances = pairwise_distances(features, features[rows])
+            for i, e in enumerate(encoded):
+                if e is not None:
+                    silhouette_sums[i] += row_silhouettes(distances, rows, *e).sum()
+
+    results = []
+    for cluster_labels, e, silhouette_sum in zip(label_sets, encoded, silhouette_sums):
+        if e is None:
+            results.append(failed_score("degenerate"))
+            continue
+        results.append({
+            'Silhouette Score': float(silhouette_sum / n_samples),
+            'Davies-Bouldin Index': davies_bouldin_score(features, cluster_labels),
+            'Calinski-Harabasz Index': calinski_harabasz_score(features, cluster_labels)
+        })
+    return results
+
+def chunked_scores(features, cluster_labels, chunk_rows):
+    # Exact Davies-Bouldin and Calinski-Harabasz in two passes over row chunks, as sklearn computes them
+    labels, cluster_ids = np.unique(np.asarray(cluster_labels), return_inverse=True)
+    n_samples, n_labels = len(cluster_ids), len(labels)
+    if not 1 < n_labels < n_samples:
+        raise ValueError(f"Number of labels is {n_labels}. Valid values are 2 to n_samples - 1 (inclusive)")
+
+    sums = np.zeros((n_labels, features.shape[1]))
+    counts = np.bincount(cluster_ids, minlength=n_labels)
+    for start in range(0, n_samples, chunk_rows):
+        ids = cluster_ids[start:start + chunk_rows]
+        membership = csr_matrix((np.ones(len(ids)), (ids, np.arange(len(ids)))), shape=(n_labels, len(ids)))
+        sums += membership @ np.asarray(features[start:start + chunk_rows], dtype=np.float64)
+    centroids = sums / counts[:, None]
+    mean = sums.sum(axis=0) / n_samples
+
+    intra_dists = np.zeros(n_labels)
+    intra_disp = 0.0
+    for start in range(0, n_samples, chunk_rows):
+        ids = cluster_ids[start:start + chunk_rows]
+        squared = ((np.asarray(features[start:start + chunk_rows], dtype=np.float64) - centroids[ids]) ** 2).sum(axis=1)
+        intra_dists += np.bincount(ids, weights=np.sqrt(squared), minlength=n_labels)
+        intra_disp += squared.sum()
+    intra_dists /= counts
+
+    extra_disp = float(np.sum(counts * ((centroids - mean) ** 2).sum(axis=1)))
+    ch_index = 1.0 if intra_disp == 0.0 else extra_disp * (n_samples - n_labels) / (intra_disp * (n_labels - 1.0))
+
+    centroid_distances = pairwise_distances(centroids)
+    if np.allclose(intra_dists, 0) or np.allclose(centroid_distances, 0):
+        db_index = 0.0
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = (intra_dists[:, None] + intra_dists[None, :]) / centroid_distances
+        scores[np.isinf(scores) | np.isnan(scores)] = 0
+        db_index = float(np.mean(scores.max(axis=1)))
+    return db_index, float(ch_index)
+
+def compute_metrics(features, cluster_labels, model, silhouette_budget=None, timer=None, chunk_rows=None):
+    # A single cluster (or one cluster per row) has no defined score
+    n_labels = len(np.unique(np.asarray(cluster_labels)))
+    if not 1 < n_labels < len(cluster_labels):
+        print(f"Error: Number of labels is {n_labels}. Valid values are 2 to n_samples - 1 (inclusive)")
+        metrics = failed_score("degenerate")
+        print(metrics)
+        return metrics
 
     try:
     
-        # Silhouette Score (higher is better)
-        silhouette = silhouette_score(features, cluster_labels)
+        # Silhouette Score (higher is better), estimated from a sample on large data
+        with stage(timer, "silhouette"):
+            if silhouette_budget and silhouette_budget < len(cluster_labels):
+                silhouette, silhouette_low, silhouette_high, sample_size = sampled_silhouette(features, cluster_labels, silhouette_budget)
+            else:
+                silhouette = silhouette_score(features, cluster_labels)
+                silhouette_low = silhouette_high = silhouette
+                sample_size = len(cluster_labels)
         
-        # Davies-Bouldin Index (lower is better)
-        db_index = davies_bouldin_score(features, cluster_labels)
+        if chunk_rows:
+            # Both indices from chunked passes, the feature matrix is never loaded whole
+            with stage(timer, "davies_bouldin"):
+                db_index, ch_index = chunked_scores(features, cluster_labels, chunk_rows)
+        else:
+            # Davies-Bouldin Index (lower is better)
+            with stage(timer, "davies_bouldin"):
+                db_index = davies_bouldin_score(features, cluster_labels)
 
-        # Calinski-Harabasz Index 
-        ch_index = calinski_harabasz_score(features, cluster_labels)
+            # Calinski-Harabasz Index 
+            with stage(timer, "calinski_harabasz"):
+                ch_index = calinski_harabasz_score(features, cluster_labels)
         
         metrics = {
             'Silhouette Score': silhouette,
             'Davies-Bouldin Index': db_index,
             'Calinski-Harabasz Index': ch_index
         }
+        if silhouette_budget:
+            metrics.update({
+                'Silhouette CI Low': silhouette_low,
+                'Silhouette CI High': silhouette_high,
+                'Silhouette Sample': sample_size
+            })
 
         if "inertia_" in dir(model):
             metrics["Inertia"] = model.inertia_
-    except:
-        metrics = {
-            'Silhouette Score': -1,
-            'Davies-Bouldin Index': 1000,
-            'Calinski-Harabasz Index': 0
-        }
+    except ValueError as e:
+        # e.g. NaN in the features
+        print("Error:", e)
+        metrics = failed_score("error")
         
     print(metrics)
+    return metrics
+
+def evaluate_clustering(input_dir, output_dir, silhouette_budget=None, chunk_rows=None):
+    if os.path.exists(os.path.join(input_dir, "labels.npy")):
+        # Load labels and the shared scaled features they refer to
+        features, columns, cluster_labels = load_run(input_dir)
+    else:
+        # Runs made before binary artifacts only have the CSV
+        clustered_data = read_dataset(os.path.join(input_dir, "data_with_clusters.csv"))
+
+        # Extract cluster labels and features
+        cluster_labels = clustered_data['Cluster']
+        features = clustered_data.drop(columns=['Cluster'])
+    
+    # Load model
+    model = load_pickle(os.path.join(input_dir, "clustering_model.pkl"))
+
+    metrics = compute_metrics(features, cluster_labels, model, silhouette_budget, chunk_rows=chunk_rows)
     
     with open(os.path.join(output_dir, "metrics.json"), 'w') as fp:
         json.dump(metrics, fp)
+    return metrics
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Evaluate clustered data.')
     parser.add_argument('--input_dir', type=str, help='Path to clustered data and model directory')
     parser.add_argument('--output_dir', type=str, help='Path to output dir')
+    parser.add_argument('--silhouette_budget', type=int, help='Estimate the silhouette score from a stratified sample of at most this many rows (default: exact)', default=None)
+    parser.add_argument('--chunk_rows', type=int, help='Compute Davies-Bouldin and Calinski-Harabasz in chunks of this many rows instead of on the whole matrix', default=None)
     args = parser.parse_args()
 
-    evaluate_clustering(args.input_dir, args.output_dir)
+    evaluate_clustering(args.input_dir, args.output_dir, args.silhouette_budget, args.chunk_rows)
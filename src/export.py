@@ -0,0 +1,21 @@
+import os
+import argparse
+import pandas as pd
+from utils import load_run
+
+def export_csv(run_dir, output_csv):
+    # Rebuild the scaled features plus 'Cluster' column from the binary artifacts
+    features, columns, cluster_labels = load_run(run_dir)
+    data_with_clusters = pd.DataFrame(features, columns=columns)
+    data_with_clusters["Cluster"] = cluster_labels
+    data_with_clusters.to_csv(output_csv, index=False)
+    print(f"Clustered data exported to '{output_csv}'.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export a clustering run as data_with_clusters.csv.')
+    parser.add_argument('--run_dir', type=str, help='Path to a clustering run directory')
+    parser.add_argument('--output_csv', type=str, help='Path to the output CSV file (default: <run_dir>/data_with_clusters.csv)', default=None)
+    args = parser.parse_args()
+
+    output_csv = args.output_csv or os.path.join(args.run_dir, "data_with_clusters.csv")
+    export_csv(args.run_dir, output_csv)
@@ -1,13 +1,10 @@
-import pandas as pd
 import argparse
-import json
+from utils import read_dataset, dataset_columns
 
 def remove_columns(input_csv, output_csv, columns_to_remove):
-    # Read input CSV file
-    data = pd.read_csv(input_csv)
-
-    # Remove specified columns
-    data.drop(columns=columns_to_remove, inplace=True, errors='ignore')
+    # Read only the columns that are kept
+    columns_to_remove = set(columns_to_remove or [])
+    data = read_dataset(input_csv, [column for column in dataset_columns(input_csv) if column not in columns_to_remove])
 
     # Save the modified data to output CSV file
     data.to_csv(output_csv, index=False)
@@ -1,28 +1,67 @@
 import os
+import json
+import math
+import time
+import signal
+import cProfile
+import hashlib
+import tempfile
 import subprocess
+import multiprocessing
 import argparse
 from itertools import product
+import numpy as np
 from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pandas as pd
 from sklearn.preprocessing import MinMaxScaler
-from utils import load_json, dump_json, overall_metrics
+from threadpoolctl import threadpool_limits
+from utils import load_json, dump_json, overall_metrics, failed_score, file_hash, dataset_hash, load_scaling, load_labels, peak_rss_mb, process_peak_mb, process_tree_usage, StageTimer, timing_columns
+import train
+import eval as evaluation
+import pca
+from sweep import SWEEPS, WARM_SWEEPS
+from results import append_results, load_results, score_results, write_best, write_summary, label_counts
 
-def run_process(command):
-    output = subprocess.check_output(command, stderr=subprocess.STDOUT, universal_newlines=True)
+# Read-only scaling cache entries and PCA projections opened by this (worker) process, keyed by entry directory
+_scalings = {}
+_projections = {}
+
+def run_process(command, timer=None, name=None, interval=0.05):
+    # CPU comes from wait4, which only counts this subprocess. wait4's maxrss would also count the parent's
+    # memory at fork time, so the peak is polled from the subprocess (and its workers) while it runs
+    start = time.perf_counter()
+    with tempfile.TemporaryFile('w+') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, universal_newlines=True)
+        peak = 0.0
+        while True:
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            peak = max(peak, process_peak_mb(process.pid), process_tree_usage(process.pid)[0])
+            time.sleep(interval)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        log.seek(0)
+        output = log.read()
+    if timer is not None:
+        timer.record(name, time.perf_counter() - start, usage.ru_utime + usage.ru_stime, peak)
     print(output)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command, output)
     return output
 
-def main(data_path="../data/preprocessed_data_all.csv", gs_path="../config/gs.json", config_path="../config/config.json", out_dir="../out"):
-    gs_config = load_json(gs_path)
-
-    summary = []
-
+def build_candidates(gs_config):
+    candidates = []
     for gsc in gs_config["gs"]:
 
         class_name = gsc["class_name"]
         hparams = gsc["hparams"]
         fit_params = gsc["fit_params"]
 
+        # Estimator-level budget overrides the grid-wide one
+        budget = dict(gs_config.get("budget", {}))
+        budget.update(gsc.get("budget", {}))
+
         for k, v in hparams.items():
             if not isinstance(v, list):
                 hparams[k] = [v]
@@ -35,73 +74,512 @@ def main(data_path="../data/preprocessed_data_all.csv", gs_path="../config/gs.js
                 "hparams" : c,
                 "fit_params" : fit_params
             }
-            dump_json(config, config_path)
-
             for scaling in gs_config["scaling"]:
-                
                 out_foldername = [class_name]
                 for k, v in c.items():
                     out_foldername.append(f"{k}={v}")
                 out_foldername.append(f"scaling={scaling}")
                 out_foldername = '-'.join(out_foldername)
-                out_path = os.path.join(out_dir, out_foldername)
-                if not os.path.exists(out_path):
-                    os.makedirs(out_path)
-                
+
                 current_candidate = deepcopy(config)
                 current_candidate["scaling"] = scaling
-                dump_json(current_candidate, os.path.join(out_path, "config.json"))
-
-                try:
-                    # TRAIN
-                    # python ./src/train.py --config_path ./config/example.json --scaling_option standard --input_csv ./example.csv --output_dir ./out
-                    print(f"Clustering for {class_name} with hparams {str(c)} and scaling {scaling}...")
-                    train_command = ["python", "train.py", "--config_path", config_path, "--scaling_option", scaling, "--input_csv", data_path, "--output_dir", out_path]
-                    train_output = run_process(train_command)
-                    
-                    # EVAL
-                    # python ./src/eval.py --input_csv ./out/data_with_clusters.csv --output_dir ./out
-                    print("Evaluation...")
-                    eval_command = ["python", "eval.py", "--input_dir", out_path, "--output_dir", out_path]
-                    eval_output = run_process(eval_command)
-
-                    ## get score
-                    score = load_json(os.path.join(out_path, "metrics.json"))
-                    score.update({
-                        "Name": out_foldername
-                    })
-                    summary.append(score)
-
-                    # PCA
-                    # python ./src/pca.py --dataset_path ./out/data_with_clusters.csv --output_dir ./out
-                    print("Performing PCA...")
-                    pca_command = ["python", "pca.py", "--dataset_path", os.path.join(out_path, "data_with_clusters.csv"), "--output_dir", out_path]
-                    pca_output = run_process(pca_command)
-                except subprocess.CalledProcessError as e:
-                    print("Error:", e.output)
-                print("="*64)
+                if budget:
+                    current_candidate["budget"] = budget
+                if "sweep" in gsc:
+                    current_candidate["sweep"] = gsc["sweep"]
+                candidates.append((out_foldername, current_candidate))
+    return candidates
 
-    print("Summarize scoere and saving best candidate...")
+def candidate_key(data_hash, config):
+    # Content address of a candidate: same data and same settings give the same key
+    content = {
+        "dataset": data_hash,
+        "class_name": config["class_name"],
+        "hparams": config["hparams"],
+        "fit_params": config["fit_params"],
+        "scaling": config["scaling"],
+    }
+    # Streamed fits differ from full-batch ones
+    if config.get("chunk_rows"):
+        content["chunk_rows"] = config["chunk_rows"]
+    # So do warm-started ones, which also depend on the other candidates of the sweep
+    if config.get("warm_start"):
+        content["warm_start"] = True
+    return hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+def load_finished(out_path, config):
+    # Reuse a candidate folder only if it holds metrics computed for this exact key
+    config_path = os.path.join(out_path, "config.json")
+    if not os.path.exists(config_path):
+        return None
+    previous = load_json(config_path)
+    if previous.get("key") != config["key"]:
+        raise FileExistsError(f"{out_path} holds results for another dataset or configuration, use --overwrite to replace them")
+    metrics_path = os.path.join(out_path, "metrics.json")
+    if not os.path.exists(metrics_path):
+        return None
+    metrics = load_json(metrics_path)
+    status = metrics.get("Status", "ok")
+    # Errors may be transient (full disk, killed worker), they are always rerun
+    if status == "error":
+        return None
+    # A candidate that overran its budget, or that an early-stopped sweep skipped, gets another chance once those settings change
+    if status in ("timeout", "oom", "stopped") and (previous.get("budget") != config.get("budget") or previous.get("sweep") != config.get("sweep")):
+        return None
+    return metrics
+
+def record_failure(out_path, status, stages):
+    score = failed_score(status)
+    dump_json(score, os.path.join(out_path, "metrics.json"))
+    dump_json({"stages": stages}, os.path.join(out_path, "timings.json"))
+    return score
+
+def open_scaling(entry_dir):
+    # Memory-mapped, so every worker shares the same pages of the cached matrix
+    if entry_dir not in _scalings:
+        _scalings[entry_dir] = load_scaling(entry_dir)
+    return _scalings[entry_dir]
+
+def open_projection(entry_dir, method):
+    if entry_dir not in _projections:
+        _projections[entry_dir] = pca.load_projection(entry_dir, {}, method)
+    return _projections[entry_dir]
+
+def init_worker(n_threads):
+    # Avoid oversubscribing cores when every worker runs a multi-threaded estimator
+    threadpool_limits(n_threads)
+
+def run_isolated(config_path, scaling, data_path, out_path, cache_dir, options, timer):
+    # Only coarse train/eval/pca stages, one per subprocess
+    # TRAIN
+    # python ./src/train.py --config_path ./config/example.json --scaling_option standard --input_csv ./example.csv --output_dir ./out --cache_dir ./cache
+    train_command = ["python", "train.py", "--config_path", config_path, "--scaling_option", scaling, "--input_csv", data_path, "--output_dir", out_path, "--cache_dir", cache_dir]
+    if options.get("chunk_rows"):
+        train_command += ["--chunk_rows", str(options["chunk_rows"])]
+    train_output = run_process(train_command, timer, "train")
     
-    summary = pd.DataFrame(summary)
-    columns = list(summary.columns)
-    columns.remove("Name")
-    summary = summary[["Name"] + columns]
-    summary["ch_scaled"] = MinMaxScaler().fit_transform(summary[["Calinski-Harabasz Index"]])
-    summary["overall"] = summary.apply(overall_metrics, axis=1)
-    summary = summary[["Name"] + columns + ["overall"]]
-    summary.to_csv(os.path.join(out_dir, "summary_score.csv"), index=False)
+    # EVAL
+    # python ./src/eval.py --input_dir ./out --output_dir ./out
+    print("Evaluation...")
+    eval_command = ["python", "eval.py", "--input_dir", out_path, "--output_dir", out_path]
+    if options.get("silhouette_budget"):
+        eval_command += ["--silhouette_budget", str(options["silhouette_budget"])]
+    if options.get("chunk_rows"):
+        eval_command += ["--chunk_rows", str(options["chunk_rows"])]
+    eval_output = run_process(eval_command, timer, "eval")
+
+    ## get score
+    score = load_json(os.path.join(out_path, "metrics.json"))
+
+    # PCA
+    # python ./src/pca.py --run_dir ./out --output_dir ./out
+    print("Performing PCA...")
+    pca_command = ["python", "pca.py", "--run_dir", out_path, "--output_dir", out_path, "--method", options["pca_method"]]
+    if options.get("plot_points"):
+        pca_command += ["--max_points", str(options["plot_points"])]
+    pca_output = run_process(pca_command, timer, "pca")
+    return score
+
+def run_in_process(config, entry_dir, out_path, options, timer, fitted=None):
+    # TRAIN
+    with timer.stage("load"):
+        data_scaled, columns, scaler = open_scaling(entry_dir)
+        train.link_scaling(entry_dir, out_path)
+    if fitted is not None:
+        # Time spent inside the sweep on this candidate
+        model, cluster_labels, timer.stages["fit"] = fitted
+        fitted = (model, cluster_labels)
+    if options.get("chunk_rows"):
+        # Out of core: the memory-mapped features are only ever read in chunks
+        cluster_labels, model = train.cluster_streaming(config, data_scaled, out_path, options["chunk_rows"], timer=timer)
+        features = data_scaled
+    else:
+        features, cluster_labels, model = train.cluster_scaled(config, data_scaled, columns, out_path, fitted, timer)
+
+    # EVAL, unless it is left to the batch evaluation of the whole scaling group
+    if options.get("batch_eval"):
+        score = {"Inertia": model.inertia_} if "inertia_" in dir(model) else {}
+    else:
+        print("Evaluation...")
+        score = evaluation.compute_metrics(features, cluster_labels, model, options.get("silhouette_budget"), timer, options.get("chunk_rows"))
+
+    # PCA, the projection is shared by the scaling entry so only the colors change
+    print("Plotting PCA...")
+    with timer.stage("pca"):
+        principal_components = open_projection(entry_dir, options["pca_method"])
+    with timer.stage("plot"):
+        pca.plot_projection(principal_components, cluster_labels, "Cluster", False, out_path, options.get("plot_points"))
+
+    # metrics.json is written last, it marks the candidate as finished
+    if not options.get("batch_eval"):
+        dump_json(score, os.path.join(out_path, "metrics.json"))
+    return score
+
+def run_candidate(name, config, out_path, data_path, cache_dir, entry_dir, options, fitted=None):
+    print(f"Clustering for {config['class_name']} with hparams {str(config['hparams'])} and scaling {config['scaling']}...")
+    timer = StageTimer()
+    try:
+        if fitted is not None and fitted[0] is None:
+            # The sweep stopped before reaching this candidate
+            print("Not fitted, the sweep stopped early.")
+            score = record_failure(out_path, "stopped", {})
+        elif entry_dir is None:
+            score = run_isolated(os.path.join(out_path, "config.json"), config["scaling"], data_path, out_path, cache_dir, options, timer)
+        else:
+            score = run_in_process(config, entry_dir, out_path, options, timer, fitted)
+        dump_json({"stages": timer.stages}, os.path.join(out_path, "timings.json"))
+    except subprocess.CalledProcessError as e:
+        print("Error:", e.output)
+        # Do not let a half-finished candidate look complete on the next run
+        score = record_failure(out_path, "oom" if "MemoryError" in e.output else "error", timer.stages)
+    except MemoryError:
+        print("Error: out of memory")
+        score = record_failure(out_path, "oom", timer.stages)
+    except Exception as e:
+        print("Error:", repr(e))
+        score = record_failure(out_path, "error", timer.stages)
+    finally:
+        print("="*64)
+    score.update({
+        "Name": name
+    })
+    return score
+
+def guarded_child(connection, target, args):
+    # Own process group, so a kill also reaches the train/eval/PCA subprocesses of isolated runs
+    os.setpgid(0, 0)
+    connection.send(target(*args))
+    connection.close()
+
+def run_budgeted(target, args, budget, interval=0.1):
+    # Call target(*args) in a forked child, killed as soon as it overruns its wall-clock or resident memory budget
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.get_context("fork").Process(target=guarded_child, args=(sender, target, args))
+    start = time.perf_counter()
+    process.start()
+    sender.close()
+    try:
+        os.setpgid(process.pid, process.pid)
+    except OSError:
+        pass
+
+    status, rss, cpu, peak = None, 0.0, 0.0, 0.0
+    while not receiver.poll(interval):
+        if not process.is_alive():
+            break
+        rss, cpu = process_tree_usage(process.pid)
+        peak = max(peak, rss)
+        if budget.get("seconds") and time.perf_counter() - start > budget["seconds"]:
+            status = "timeout"
+        elif budget.get("memory_mb") and rss > budget["memory_mb"]:
+            status = "oom"
+        if status is not None:
+            os.killpg(process.pid, signal.SIGKILL)
+            break
+
+    result = None
+    if status is None:
+        try:
+            result = receiver.recv()
+        except EOFError:
+            # Died without reporting, most likely taken by the kernel OOM killer; reaped first so exitcode is set
+            process.join()
+            status = "oom" if process.exitcode == -signal.SIGKILL else "error"
+    process.join()
+    receiver.close()
+    return result, status, {"wall": time.perf_counter() - start, "cpu": cpu, "peak_rss_mb": peak}
+
+def run_guarded(job, budget):
+    # A candidate under a watchdog, recorded as failed when it is stopped
+    name, config, out_path = job[:3]
+    score, status, usage = run_budgeted(run_candidate, job, budget)
+    if score is not None:
+        return score
+
+    print(f"{name} stopped: {status} after {usage['wall']:.1f}s at {usage['peak_rss_mb']:.0f} MB")
+    print("="*64)
+    score = record_failure(out_path, status, {"run": usage})
+    score.update({
+        "Name": name
+    })
+    return score
+
+def run_job(job):
+    # Candidates with a budget run under a watchdog, the others directly
+    budget = job[1].get("budget")
+    if budget:
+        return run_guarded(job, budget)
+    return run_candidate(*job)
+
+def with_timings(score, out_path):
+    timings_path = os.path.join(out_path, "timings.json")
+    if os.path.exists(timings_path):
+        score.update(timing_columns(load_json(timings_path)["stages"]))
+    return score
+
+def record_results(out_dir, summary, rows):
+    # Appended to the store as soon as they finish, best_candidate.json follows the runs done so far
+    for row in rows:
+        if "Status" not in row:
+            row.update(label_counts(os.path.join(out_dir, row["Name"])))
+    append_results(out_dir, rows)
+    summary.extend(rows)
+    write_best(out_dir, score_results(pd.DataFrame(summary)))
+
+def profile_candidates(jobs, summary, top):
+    # Rerun the slowest candidates under cProfile in a scratch folder, keeping only the profile
+    slowest = sorted((row for row in summary if "time_total" in row), key=lambda row: row["time_total"], reverse=True)[:top]
+    by_name = {job[0]: job for job in jobs}
+    for row in slowest:
+        if row["Name"] not in by_name:
+            continue
+        name, config, out_path, data_path, cache_dir, entry_dir, options = by_name[row["Name"]][:7]
+        print(f"Profiling {name}...")
+        with tempfile.TemporaryDirectory() as scratch:
+            profiler = cProfile.Profile()
+            profiler.runcall(run_in_process, config, entry_dir, scratch, dict(options, batch_eval=False), StageTimer())
+        profiler.dump_stats(os.path.join(out_path, "profile.prof"))
 
-    best_candidate = summary.loc[summary["overall"] == summary.overall.max()].iloc[0].to_dict()
+def batch_evaluate(pending):
+    # One pass over pairwise distances per scaling entry scores all of its candidates
+    groups = {}
+    for score, out_path, entry_dir in pending:
+        groups.setdefault(entry_dir, []).append((score, out_path))
+
+    summary = []
+    for entry_dir, group in groups.items():
+        print(f"Batch evaluation of {len(group)} candidates...")
+        data_scaled, columns, scaler = open_scaling(entry_dir)
+        label_sets = [load_labels(out_path) for score, out_path in group]
+        for (score, out_path), metrics in zip(group, evaluation.batch_metrics(data_scaled, label_sets)):
+            metrics.update(score)
+            name = metrics.pop("Name")
+            dump_json(metrics, os.path.join(out_path, "metrics.json"))
+            metrics.update({
+                "Name": name
+            })
+            summary.append(metrics)
+    return summary
+
+def stratified_rows(entry_dir, n_rows, pca_method, n_strata=10, random_state=0):
+    # Strata are quantile bins of the first principal component of the scaling entry
+    pc1 = np.asarray(open_projection(entry_dir, pca_method)[:, 0])
+    edges = np.quantile(pc1, np.linspace(0, 1, n_strata + 1)[1:-1])
+    strata, strata_ids, counts = np.unique(np.searchsorted(edges, pc1), return_inverse=True, return_counts=True)
+    return evaluation.stratified_sample(strata_ids, counts, n_rows, random_state)
+
+def screen_candidate(config, data_scaled, silhouette_budget):
+    model, cluster_labels = train.fit_labels(config, data_scaled)
+    return evaluation.compute_metrics(data_scaled, cluster_labels, model, silhouette_budget)
+
+def screen_candidates(candidates, entries, options, min_rows, eta):
+    # Successive halving: score every candidate on a small sample, promote the best 1/eta to eta times more rows
+    n_total = len(open_scaling(next(iter(entries.values())))[0])
+    n_rows, survivors, rounds = min_rows, candidates, []
+    while n_rows < n_total and len(survivors) > 1:
+        print(f"Screening {len(survivors)} candidates on {n_rows} rows...")
+        samples = {scaling: stratified_rows(entry_dir, n_rows, options["pca_method"]) for scaling, entry_dir in entries.items()}
+        scores = []
+        for name, config in survivors:
+            data_scaled = np.asarray(open_scaling(entries[config["scaling"]])[0][samples[config["scaling"]]])
+            try:
+                if config.get("budget"):
+                    # Same watchdog as the full runs, a stalled or exploding fit only fails its own candidate
+                    score, status, usage = run_budgeted(screen_candidate, (config, data_scaled, options.get("silhouette_budget")), config["budget"])
+                    if score is None:
+                        print(f"{name} stopped: {status} after {usage['wall']:.1f}s at {usage['peak_rss_mb']:.0f} MB")
+                        score = failed_score(status)
+                else:
+                    score = screen_candidate(config, data_scaled, options.get("silhouette_budget"))
+            except Exception as e:
+                print("Error:", e)
+                score = failed_score("error")
+            score.update({
+                "Name": name,
+                "Rows": n_rows
+            })
+            scores.append(score)
+
+        scores = pd.DataFrame(scores)
+        scores["ch_scaled"] = MinMaxScaler().fit_transform(scores[["Calinski-Harabasz Index"]])
+        scores["overall"] = overall_metrics(scores).fillna(-np.inf)
+        rounds.append(scores)
+
+        n_keep = max(1, math.ceil(len(survivors) / eta))
+        keep = set(scores.sort_values("overall", ascending=False, kind="stable")["Name"].iloc[:n_keep])
+        survivors = [(name, config) for name, config in survivors if name in keep]
+        n_rows *= eta
+    return survivors, rounds
+
+def sweep_jobs(jobs):
+    # Group candidates that a sweep can fit together, the rest run one by one
+    groups, single = {}, []
+    for job in jobs:
+        name, config, out_path, data_path, cache_dir, entry_dir, options = job
+        # A budgeted candidate has to be fitted alone to be stopped alone
+        if config["class_name"] in SWEEPS and not config.get("budget") and (config["class_name"] not in WARM_SWEEPS or config.get("warm_start")):
+            groups.setdefault((config["class_name"], config["scaling"]), []).append(job)
+        else:
+            single.append(job)
+
+    for (class_name, scaling), group in groups.items():
+        print(f"Sweeping {len(group)} candidates of {class_name} with scaling {scaling}...")
+        by_config = {id(job[1]): job for job in group}
+        data_scaled, columns, scaler = open_scaling(group[0][5])
+        results = SWEEPS[class_name]([job[1] for job in group], data_scaled)
+        while True:
+            # Each candidate is charged the sweep time spent producing it
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                config, model, cluster_labels = next(results)
+            except StopIteration:
+                break
+            fit_stage = {"wall": time.perf_counter() - wall, "cpu": time.process_time() - cpu, "peak_rss_mb": peak_rss_mb()}
+            yield by_config[id(config)] + ((model, cluster_labels, fit_stage),)
+
+    for job in single:
+        yield job
+
+def main(data_path="../data/preprocessed_data_all.csv", gs_path="../config/gs.json", out_dir="../out", isolate=False, workers=1, sweep=False, cache_dir="../cache", overwrite=False, silhouette_budget=None, batch_eval=False, pca_method=None, plot_points=None, search="grid", min_rows=2000, eta=3, profile_top=0, chunk_rows=None):
+    gs_config = load_json(gs_path)
+    candidates = build_candidates(gs_config)
+
+    summary = []
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    # Streaming hashes the file in blocks, the columnar cache would parse it whole
+    data_hash = file_hash(data_path) if chunk_rows else dataset_hash(data_path)
+    if pca_method is None:
+        pca_method = "incremental" if chunk_rows else "exact"
+    options = {
+        "silhouette_budget": silhouette_budget,
+        "batch_eval": batch_eval and not isolate and not chunk_rows,
+        "pca_method": pca_method,
+        "plot_points": plot_points,
+        "chunk_rows": chunk_rows
+    }
+
+    # Stages shared by every candidate of this dataset
+    timer = StageTimer()
+
+    # Scale once per option, every in-process candidate memory-maps the cached matrix
+    entries = {}
+    if not isolate or search == "halving":
+        data = None
+        for scaling in gs_config["scaling"]:
+            if not os.path.exists(os.path.join(train.scaling_entry(data_path, scaling, cache_dir, data_hash), "features.npy")) and data is None and not chunk_rows:
+                with timer.stage("load"):
+                    data = train.load_data(data_path)
+            entries[scaling] = train.cache_scaling(data_path, scaling, cache_dir, data, data_hash, timer, chunk_rows)
+        del data
+
+        # Fit the PCA projection of each scaling once, before workers start plotting
+        for entry_dir in entries.values():
+            pca.cache_projection(entry_dir, {}, pca_method, timer)
+
+    if search == "halving":
+        with timer.stage("halving"):
+            candidates, rounds = screen_candidates(candidates, entries, options, min_rows, eta)
+        if rounds:
+            pd.concat(rounds).to_csv(os.path.join(out_dir, "halving_score.csv"), index=False)
+        print(f"{len(candidates)} candidates promoted to the full data.")
+
+    # Folders finished before the results store existed are added to it once
+    stored = load_results(out_dir)
+    stored = set(stored["Name"]) if len(stored) else set()
+    migrated = []
+
+    jobs = []
+    for name, config in candidates:
+        out_path = os.path.join(out_dir, name)
+        if chunk_rows:
+            config["chunk_rows"] = chunk_rows
+        if sweep and not isolate and not chunk_rows and config["class_name"] in WARM_SWEEPS and config.get("sweep", {}).get("warm_start") and not config.get("budget"):
+            config["warm_start"] = True
+        config["key"] = candidate_key(data_hash, config)
+
+        score = None if overwrite else load_finished(out_path, config)
+        if score is not None:
+            print(f"Skipping {name}, already computed.")
+            score.update({
+                "Name": name
+            })
+            summary.append(with_timings(score, out_path))
+            if name not in stored:
+                score.update(label_counts(out_path))
+                migrated.append(score)
+            continue
+
+        if not os.path.exists(out_path):
+            os.makedirs(out_path)
+        elif os.path.exists(os.path.join(out_path, "metrics.json")):
+            os.remove(os.path.join(out_path, "metrics.json"))
+        dump_json(config, os.path.join(out_path, "config.json"))
+        jobs.append((name, config, out_path, data_path, cache_dir, None if isolate else entries[config["scaling"]], options))
+
+    if migrated:
+        append_results(out_dir, migrated)
+
+    profile_jobs = jobs
+    if sweep and not isolate and not chunk_rows:
+        jobs = sweep_jobs(jobs)
+
+    # With batch evaluation the finished candidates still lack scores, they are recorded after it
+    pending = []
+    def finish(score, job):
+        if options["batch_eval"] and "Status" not in score:
+            pending.append((score, job))
+        else:
+            record_results(out_dir, summary, [with_timings(score, job[2])])
+
+    if workers > 1:
+        n_threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(n_threads,)) as executor:
+            futures = {executor.submit(run_job, job): job for job in jobs}
+            for future in as_completed(futures):
+                finish(future.result(), futures[future])
+    else:
+        for job in jobs:
+            finish(run_job(job), job)
+
+    if pending:
+        with timer.stage("batch_eval"):
+            scores = batch_evaluate([(score, job[2], job[5]) for score, job in pending])
+        record_results(out_dir, summary, [with_timings(score, os.path.join(out_dir, score["Name"])) for score in scores])
+
+    if profile_top and not isolate:
+        profile_candidates(profile_jobs, summary, profile_top)
+    dump_json({"stages": timer.stages}, os.path.join(out_dir, "timings.json"))
+
+    print("Summarize scoere and saving best candidate...")
 
-    dump_json(best_candidate, os.path.join(out_dir, "best_candidate.json"))
+    # The store may hold candidates of other grids written to the same folder
+    names = set(name for name, config in candidates)
+    summary = load_results(out_dir)
+    summary = score_results(summary[summary["Name"].isin(names)])
+    write_summary(out_dir, summary)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Perform grid search.')
     parser.add_argument('--data', type=str, help="CSV data file.", default="../data/preprocessed_data_all.csv")
     parser.add_argument('--gs', type=str, help="Grid search config JSON file.", default="../config/gs.json")
-    parser.add_argument('--config', type=str, help="Config JSON file.", default="../config/gs.json")
     parser.add_argument('--out', type=str, help="Output directory", default="../out")
+    parser.add_argument('--isolate', action='store_true', help="Run train, eval and PCA of every candidate as separate Python processes instead of in-process; their timings only have one train, eval and pca stage each.")
+    parser.add_argument('--workers', type=int, help="Number of candidates to run in parallel.", default=1)
+    parser.add_argument('--sweep', action='store_true', help="Fit candidates of estimators with a shared-work sweep (e.g. DBSCAN) together instead of independently. KMeans candidates are warm-started only when their grid entry sets \"sweep\": {\"warm_start\": true}.")
+    parser.add_argument('--cache', type=str, help="Scaling cache directory, shared by every dataset and sweep.", default="../cache")
+    parser.add_argument('--overwrite', action='store_true', help="Recompute every candidate, replacing folders from earlier or different runs.")
+    parser.add_argument('--silhouette_budget', type=int, help="Estimate silhouette from a stratified sample of at most this many rows instead of all pairs.", default=None)
+    parser.add_argument('--batch_eval', action='store_true', help="Score all candidates of a scaling together with exact metrics in one pass over pairwise distances.")
+    parser.add_argument('--pca_method', type=str, help="PCA used for the shared projection (exact, randomized, incremental), default exact or incremental with --chunk_rows.", default=None)
+    parser.add_argument('--plot_points', type=int, help="Downsample scatter plots to about this many points, keeping every cluster.", default=None)
+    parser.add_argument('--search', type=str, help="Search strategy: grid (every candidate on the full data) or halving (successive halving on growing stratified samples).", default="grid")
+    parser.add_argument('--min_rows', type=int, help="Rows of the first halving round.", default=2000)
+    parser.add_argument('--eta', type=int, help="Halving factor: each round keeps 1/eta of the candidates on eta times more rows.", default=3)
+    parser.add_argument('--profile_top', type=int, help="Rerun the N slowest candidates under cProfile and save profile.prof in their folders.", default=0)
+    parser.add_argument('--chunk_rows', type=int, help="Out-of-core mode: stream the data in chunks of this many rows, for estimators with partial_fit (MiniBatchKMeans, Birch).", default=None)
     args = parser.parse_args()
 
-    main(data_path=args.data, gs_path=args.gs, config_path=args.config, out_dir=args.out)
\ No newline at end of file
+    main(data_path=args.data, gs_path=args.gs, out_dir=args.out, isolate=args.isolate, workers=args.workers, sweep=args.sweep, cache_dir=args.cache, overwrite=args.overwrite, silhouette_budget=args.silhouette_budget, batch_eval=args.batch_eval, pca_method=args.pca_method, plot_points=args.plot_points, search=args.search, min_rows=args.min_rows, eta=args.eta, profile_top=args.profile_top, chunk_rows=args.chunk_rows)
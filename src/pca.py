@@ -1,10 +1,18 @@
+import numpy as np
 import pandas as pd
 import argparse
 import json
 import random
 import os
-from sklearn.decomposition import PCA
+import hashlib
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils import gen_batches
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib.colors import to_rgba_array
+from matplotlib.lines import Line2D
+from utils import load_labels, run_entry, load_scaling, read_dataset, stage
 
 distinct_colors = [
     '#1f77b4', '#ff7f0e', '#2ca02c', '#d62728', '#9467bd', '#8c564b',
@@ -38,88 +46,155 @@ def get_color(index):
     mc1, mc2 = mutate_hex_colors(distinct_colors[index], distinct_colors[index-1])
     return random.choice([mc1, mc2])
 
-
-def save_scatter(df, label_column, without_label, out_path):
-    # Determine the number of clusters from the unique values in 'Cluster' column
-
-    # Create a list of unique cluster labels
-    cluster_labels = df[label_column].unique()
-
-    # Create subplots
-    fig, axes = plt.subplots(nrows=1, ncols=2, figsize=(12, 5))
-    if not without_label:
-        for i, label in enumerate(cluster_labels):
-            cluster_data = df[df[label_column] == label]
-            axes[0].scatter(cluster_data['PC1'], cluster_data['PC2'], color=get_color(i), label=f'{label_column} {label}')
+def downsample(codes, max_points, random_state=0):
+    # Same sampling rate in every cluster keeps relative densities, and each cluster keeps a point
+    rng = np.random.default_rng(random_state)
+    rate = max_points / len(codes)
+    keep = rng.random(len(codes)) < rate
+    first = np.unique(codes, return_index=True)[1]
+    keep[first] = True
+    return np.flatnonzero(keep)
+
+def save_scatter(df, label_column, without_label, out_path, max_points=None, max_legend=40):
+    # Map every label to a color index once, in order of first appearance
+    if without_label:
+        codes, cluster_labels = np.zeros(len(df), dtype=int), np.array([None])
     else:
-        axes[0].scatter(df['PC1'], df['PC2'], color=get_color(0))
-    
-    axes[0].set_xlabel('PC1')
-    axes[0].set_ylabel('PC2')
+        codes, cluster_labels = pd.factorize(df[label_column])
+    palette = to_rgba_array([get_color(i) for i in range(len(cluster_labels))])
+
+    # Draw clusters in label order so later clusters stay on top, as separate artists did
+    rows = np.argsort(codes, kind="stable")
+    if max_points is not None and len(rows) > max_points:
+        rows = rows[downsample(codes[rows], max_points)]
+    points = df[['PC1', 'PC2', 'PC3']].to_numpy()[rows]
+    colors = palette[codes[rows]]
+
+    # Create subplots, one vectorized draw per axis
+    fig = plt.figure(figsize=(12, 5))
+    ax2d = fig.add_subplot(121)
+    ax2d.scatter(points[:, 0], points[:, 1], c=colors)
+    ax2d.set_xlabel('PC1')
+    ax2d.set_ylabel('PC2')
 
     ax = fig.add_subplot(122, projection='3d')
-    if not without_label:
-        for i, label in enumerate(cluster_labels):
-            cluster_data = df[df[label_column] == label]
-            ax.scatter(cluster_data['PC1'], cluster_data['PC2'], cluster_data['PC3'], color=get_color(i), label=f'{label_column} {label}')
-    else:
-        ax.scatter(df['PC1'], df['PC2'], df['PC3'], color=get_color(0))
-    
+    ax.scatter(points[:, 0], points[:, 1], points[:, 2], c=colors)
     ax.set_xlabel('PC1')
     ax.set_ylabel('PC2')
     ax.set_zlabel('PC3')
 
     # Set plot titles
-    axes[0].set_title('2D Scatter Plot (PC1 vs PC2)')
+    ax2d.set_title('2D Scatter Plot (PC1 vs PC2)')
     ax.set_title('3D Scatter Plot (PC1 vs PC2 vs PC3)')
 
     if not without_label:
-        plt.legend()
+        handles = [
+            Line2D([], [], linestyle='', marker='o', color=palette[i], label=f'{label_column} {label}')
+            for i, label in enumerate(cluster_labels[:max_legend])
+        ]
+        ax.legend(handles=handles)
 
     # Display the plot
-    plt.tight_layout()
+    fig.tight_layout()
 
     # Save the plot to a JPG file
-    plt.savefig(out_path)
-
-def perform_pca(dataset_path, label_column, without_label, pca_params, output_dir):
-    # Load dataset
-    data = pd.read_csv(dataset_path)
-
-    # Extract features (excluding label column)
-    label_or_cluster = data[label_column]
-    features = data.drop(columns=[label_column])
-
-    # Perform PCA
-    pca = PCA(n_components=3, **pca_params)
+    fig.savefig(out_path)
+    plt.close(fig)
+
+def fit_projection(features, pca_params, method="exact", chunk_rows=65536):
+    # Randomized and incremental PCA keep the cost down on very large inputs
+    if method == "incremental":
+        # Fed in row chunks so a memory-mapped matrix is never loaded whole
+        pca = IncrementalPCA(n_components=3, **pca_params)
+        for rows in gen_batches(len(features), chunk_rows, min_batch_size=3):
+            pca.partial_fit(np.asarray(features[rows]))
+        principal_components = np.concatenate([pca.transform(np.asarray(features[rows])) for rows in gen_batches(len(features), chunk_rows)])
+        return principal_components, pca
+    elif method == "randomized":
+        pca = PCA(n_components=3, svd_solver="randomized", **pca_params)
+    else:
+        pca = PCA(n_components=3, **pca_params)
     principal_components = pca.fit_transform(features)
+    return principal_components, pca
 
-    # Save principal components
-    principal_components = pd.DataFrame(principal_components, columns=['PC1', 'PC2', 'PC3'])
-    principal_components["Cluster"] = label_or_cluster
-    save_scatter(principal_components, label_column, without_label, os.path.join(output_dir, "scatter.jpg"))
-
-
+def correlation_table(pca, columns):
     # Correlation analysis
-    correlations = pd.DataFrame(pca.components_.T, columns=['PC1', 'PC2', 'PC3'], index=features.columns)
+    correlations = pd.DataFrame(pca.components_.T, columns=['PC1', 'PC2', 'PC3'], index=columns)
     correlations['PC1_abs'] = abs(correlations['PC1'])
     correlations['PC2_abs'] = abs(correlations['PC2'])
     correlations['PC3_abs'] = abs(correlations['PC3'])
     correlations['sum_PC_abs'] = correlations['PC1_abs'] + correlations['PC2_abs'] + correlations['PC3_abs']
     sorted_features = correlations.sort_values(by=['PC1_abs', 'PC2_abs', 'PC3_abs'], ascending=[False, False, False])
     sorted_features.drop(columns=['PC1_abs', 'PC2_abs', 'PC3_abs'], inplace=True)
+    return sorted_features
+
+def plot_projection(principal_components, label_or_cluster, label_column, without_label, output_dir, max_points=None):
+    # Save principal components
+    principal_components = pd.DataFrame(principal_components, columns=['PC1', 'PC2', 'PC3'])
+    principal_components[label_column] = np.asarray(label_or_cluster)
+    save_scatter(principal_components, label_column, without_label, os.path.join(output_dir, "scatter.jpg"), max_points)
+
+def projection_paths(entry_dir, pca_params, method="exact"):
+    key = hashlib.sha1(json.dumps([pca_params, method], sort_keys=True).encode()).hexdigest()[:12]
+    return os.path.join(entry_dir, f"pca-{key}.npy"), os.path.join(entry_dir, f"corr-{key}.csv")
+
+def cache_projection(entry_dir, pca_params, method="exact", timer=None):
+    # The projection only depends on the scaled features, so it is fitted once per scaling entry
+    projection_path, corr_path = projection_paths(entry_dir, pca_params, method)
+    if not os.path.exists(projection_path):
+        features, columns, scaler = load_scaling(entry_dir)
+        with stage(timer, f"pca_{os.path.basename(os.path.normpath(entry_dir))}"):
+            principal_components, pca = fit_projection(features, pca_params, method)
+        tmp_suffix = f".{os.getpid()}.tmp"
+        correlation_table(pca, columns).to_csv(corr_path + tmp_suffix, index=True)
+        os.replace(corr_path + tmp_suffix, corr_path)
+        with open(projection_path + tmp_suffix, 'wb') as file:
+            np.save(file, principal_components.astype(np.float32))
+        os.replace(projection_path + tmp_suffix, projection_path)
+    return projection_path, corr_path
+
+def load_projection(entry_dir, pca_params, method="exact"):
+    projection_path, corr_path = cache_projection(entry_dir, pca_params, method)
+    return np.load(projection_path, mmap_mode='r')
+
+def pca_features(features, label_or_cluster, label_column, without_label, pca_params, output_dir, max_points=None):
+    # Perform PCA
+    principal_components, pca = fit_projection(features, pca_params)
+    plot_projection(principal_components, label_or_cluster, label_column, without_label, output_dir, max_points)
+
+    sorted_features = correlation_table(pca, features.columns)
 
     # Save sorted feature names to output file
     corr_path = os.path.join(output_dir,"corr.csv")
     sorted_features.to_csv(corr_path, index=True)
     print(f"PCA and correlation analysis completed. Sorted feature names saved to '{corr_path}'.")
 
+def perform_pca(dataset_path, label_column, without_label, pca_params, output_dir, max_points=None):
+    # Load dataset, float32 is plenty for a 2D projection
+    data = read_dataset(dataset_path, float32=True)
+
+    # Extract features (excluding label column)
+    label_or_cluster = data[label_column]
+    features = data.drop(columns=[label_column])
+
+    pca_features(features, label_or_cluster, label_column, without_label, pca_params, output_dir, max_points)
+
+def perform_pca_run(run_dir, label_column, without_label, pca_params, output_dir, method="exact", max_points=None):
+    # Reuse the projection of the run's scaling entry, only the labels are new
+    label_or_cluster = load_labels(run_dir)
+    principal_components = load_projection(run_entry(run_dir), pca_params, method)
+    plot_projection(principal_components, label_or_cluster, label_column, without_label, output_dir, max_points)
+    print(f"Scatter plot saved to '{os.path.join(output_dir, 'scatter.jpg')}'.")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Perform PCA and correlation analysis on a dataset.')
     parser.add_argument('--dataset_path', type=str, help='Path to the input dataset CSV file')
+    parser.add_argument('--run_dir', type=str, help='Path to a clustering run directory (labels.npy), used instead of --dataset_path')
     parser.add_argument('--label_column', type=str, help='Column name for cluster or label (to exclude from features)', default="Cluster")
     parser.add_argument('--pca_params', type=str, help='Path to JSON file containing PCA parameters')
     parser.add_argument('--without_label', action='store_true', help='If true, then the visualization will not differ for each cluster (and no legend)')
+    parser.add_argument('--method', type=str, help='PCA method for --run_dir projections (exact, randomized, incremental)', default="exact")
+    parser.add_argument('--max_points', type=int, help='Downsample the scatter plot to about this many points, keeping every cluster', default=None)
     parser.add_argument('--output_dir', type=str, help='Path to output directory')
     args = parser.parse_args()
 
@@ -129,4 +204,7 @@ if __name__ == "__main__":
         with open(args.pca_params, 'r') as json_file:
             pca_params = json.load(json_file)
 
-    perform_pca(args.dataset_path, args.label_column, args.without_label, pca_params, args.output_dir)
+    if args.run_dir:
+        perform_pca_run(args.run_dir, args.label_column, args.without_label, pca_params, args.output_dir, args.method, args.max_points)
+    else:
+        perform_pca(args.dataset_path, args.label_column, args.without_label, pca_params, args.output_dir, args.max_points)
@@ -0,0 +1,73 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from sklearn.preprocessing import MinMaxScaler
+from utils import dump_json, overall_metrics
+
+# One JSON line per finished candidate, appended as candidates finish; the latest line of a name wins
+STORE = "results.jsonl"
+
+def store_path(out_dir):
+    return os.path.join(out_dir, STORE)
+
+def append_results(out_dir, rows):
+    # A single write per batch of lines, so readers mid-sweep only ever miss the line being written
+    lines = "".join(json.dumps(row) + "\n" for row in rows)
+    with open(store_path(out_dir), 'a') as file:
+        file.write(lines)
+
+def label_counts(run_dir):
+    # Cluster count and noise share straight from the int32 labels
+    labels_path = os.path.join(run_dir, "labels.npy")
+    if not os.path.exists(labels_path):
+        return {}
+    labels = np.load(labels_path)
+    return {
+        "Clusters": len(np.unique(labels[labels != -1])),
+        "Noise": float(np.mean(labels == -1))
+    }
+
+def load_results(out_dir):
+    rows = {}
+    path = store_path(out_dir)
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            for line in file:
+                try:
+                    row = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line still being written by a running sweep
+                    continue
+                rows.pop(row["Name"], None)
+                rows[row["Name"]] = row
+    return pd.DataFrame(list(rows.values()))
+
+def score_results(results):
+    # overall for every row in one vectorized pass, scores first and timings last
+    if results.empty:
+        return results
+    results = results.copy()
+    results["Status"] = results["Status"].fillna("ok") if "Status" in results else "ok"
+    columns = [c for c in results.columns if c not in ("Name", "Status", "ch_scaled", "overall")]
+    timings = [c for c in columns if c.startswith(("time_", "cpu_", "peak_rss"))]
+    columns = [c for c in columns if c not in timings]
+    results["ch_scaled"] = MinMaxScaler().fit_transform(results[["Calinski-Harabasz Index"]])
+    results["overall"] = overall_metrics(results)
+    return results[["Name", "Status"] + columns + ["overall"] + timings]
+
+def best_candidate(summary):
+    scored = summary.dropna(subset=["overall"])
+    if scored.empty:
+        return None
+    return summary.loc[scored["overall"].idxmax()].to_dict()
+
+def write_best(out_dir, summary):
+    best = best_candidate(summary)
+    if best is not None:
+        dump_json(best, os.path.join(out_dir, "best_candidate.json"))
+    return best
+
+def write_summary(out_dir, summary):
+    summary.to_csv(os.path.join(out_dir, "summary_score.csv"), index=False)
+    return write_best(out_dir, summary)
@@ -2,35 +2,32 @@ import os
 import json
 import argparse
 import pandas as pd
-from sklearn.preprocessing import MinMaxScaler
-import utils
+from results import store_path, load_results, score_results, write_summary, label_counts
 
 def summarize(directory):
-    result = []
-    listdir = os.listdir(directory)
-    for d in listdir:
-        if not os.path.isdir(os.path.join(directory, d)):
-            continue
-        try:
-            with open(os.path.join(directory, d, "metrics.json"), 'r') as fp:
-                entry = json.load(fp)
-        except:
-            continue
-        entry.update({
-            "Name" : d
-        })
-        result.append(entry)
-    result = pd.DataFrame(result)
-    result["ch_scaled"] = MinMaxScaler().fit_transform(result[["Calinski-Harabasz Index"]])
-    result["overall"] = result.apply(utils.overall_metrics, axis=1)
-    columns = list(result.columns)
-    columns.remove("Name")
-    result = result[["Name"] + columns]
-    result.to_csv(os.path.join(directory, "summary_score.csv"), index=False)
-
-    best_candidate = result.loc[result["overall"] == result.overall.max()].iloc[0].to_dict()
-
-    utils.dump_json(best_candidate, os.path.join(directory, "best_candidate.json"))
+    # Grid searches keep a results store, other folders are scanned run by run
+    if os.path.exists(store_path(directory)):
+        result = load_results(directory)
+    else:
+        result = []
+        listdir = os.listdir(directory)
+        for d in listdir:
+            if not os.path.isdir(os.path.join(directory, d)):
+                continue
+            try:
+                with open(os.path.join(directory, d, "metrics.json"), 'r') as fp:
+                    entry = json.load(fp)
+            except:
+                continue
+            entry.update({
+                "Name" : d
+            })
+            entry.update(label_counts(os.path.join(directory, d)))
+            result.append(entry)
+        result = pd.DataFrame(result)
+    # Candidates stopped by their budget carry an explicit status and no scores
+    result = score_results(result)
+    write_summary(directory, result)
 
     print("Done.., saved in", os.path.join(directory, "summary_score.csv"))
 
@@ -0,0 +1,214 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.cluster import DBSCAN, AgglomerativeClustering, KMeans
+from sklearn.neighbors import NearestNeighbors
+from sklearn.utils.extmath import row_norms
+
+try:
+    # The same expansion routine DBSCAN.fit runs after its own radius search
+    from sklearn.cluster._dbscan_inner import dbscan_inner
+except ImportError:
+    dbscan_inner = None
+
+try:
+    # The same cut AgglomerativeClustering.fit makes on a full tree
+    from sklearn.cluster._agglomerative import _hc_cut
+except ImportError:
+    _hc_cut = None
+
+def threshold_graph(graph, radius):
+    # Keep only the neighbors within radius, rows stay sorted by distance
+    mask = graph.data <= radius
+    indptr = np.concatenate([[0], np.cumsum(mask)])[graph.indptr]
+    return csr_matrix((graph.data[mask], graph.indices[mask], indptr), shape=graph.shape)
+
+def graph_neighborhoods(graph):
+    indices = graph.indices.astype(np.intp)
+    neighborhoods = np.empty(graph.shape[0], dtype=object)
+    neighborhoods[:] = np.split(indices, graph.indptr[1:-1])
+    return neighborhoods
+
+def dbscan_labels(graph, neighborhoods, eps, min_samples, sample_weight=None):
+    if dbscan_inner is None:
+        precomputed = DBSCAN(eps=eps, min_samples=min_samples, metric="precomputed")
+        precomputed.fit(graph, sample_weight=sample_weight)
+        return precomputed.core_sample_indices_, precomputed.labels_
+
+    if sample_weight is None:
+        n_neighbors = np.diff(graph.indptr)
+    else:
+        n_neighbors = np.add.reduceat(np.asarray(sample_weight)[graph.indices], graph.indptr[:-1])
+    core_samples = np.asarray(n_neighbors >= min_samples, dtype=np.uint8)
+    labels = np.full(graph.shape[0], -1, dtype=np.intp)
+    dbscan_inner(core_samples, neighborhoods, labels)
+    return np.where(core_samples)[0], labels
+
+def dbscan_sweep(configs, data_scaled):
+    # Every config shares the same neighbor search options, only eps and min_samples vary
+    groups = {}
+    for config in configs:
+        neighbor_params = {k: v for k, v in config["hparams"].items() if k not in ("eps", "min_samples")}
+        key = str(sorted(neighbor_params.items())) + str(sorted(config["fit_params"].items()))
+        groups.setdefault(key, []).append(config)
+
+    for group in groups.values():
+        hparams = DBSCAN(**group[0]["hparams"]).get_params()
+        if hparams["metric"] == "precomputed" or callable(hparams["metric"]):
+            raise ValueError("DBSCAN sweep needs a named metric to build the neighbor graph")
+
+        # One radius search at the largest eps, every smaller eps is a threshold of it
+        max_eps = max(DBSCAN(**config["hparams"]).eps for config in group)
+        neighbors_model = NearestNeighbors(
+            radius=max_eps,
+            algorithm=hparams["algorithm"],
+            leaf_size=hparams["leaf_size"],
+            metric=hparams["metric"],
+            metric_params=hparams["metric_params"],
+            p=hparams["p"],
+            n_jobs=hparams["n_jobs"],
+        )
+        neighbors_model.fit(data_scaled)
+        # Querying with the training data keeps every point as its own neighbor, like DBSCAN does
+        graph = neighbors_model.radius_neighbors_graph(data_scaled, mode="distance", sort_results=True)
+
+        by_eps = {}
+        for config in group:
+            by_eps.setdefault(DBSCAN(**config["hparams"]).eps, []).append(config)
+
+        # Walk eps downwards so each threshold shrinks the previous graph and frees it
+        for eps in sorted(by_eps, reverse=True):
+            graph = threshold_graph(graph, eps) if eps < max_eps else graph
+            neighborhoods = graph_neighborhoods(graph) if dbscan_inner is not None else None
+            for config in by_eps[eps]:
+                clustering_model = DBSCAN(**config["hparams"])
+                core_sample_indices, labels = dbscan_labels(
+                    graph, neighborhoods, eps, clustering_model.min_samples, config["fit_params"].get("sample_weight")
+                )
+
+                # Hand back a model that looks like an ordinary fit on the features
+                clustering_model.core_sample_indices_ = core_sample_indices
+                clustering_model.labels_ = labels
+                clustering_model.components_ = np.asarray(data_scaled)[core_sample_indices].copy()
+                clustering_model.n_features_in_ = data_scaled.shape[1]
+                yield config, clustering_model, labels
+            neighborhoods = None
+
+def agglomerative_sweep(configs, data_scaled):
+    # Configs that share linkage, metric and connectivity share one merge tree, only the cut differs
+    groups = {}
+    for config in configs:
+        tree_params = {k: v for k, v in config["hparams"].items() if k not in ("n_clusters", "distance_threshold", "compute_full_tree", "compute_distances")}
+        key = str(sorted(tree_params.items())) + str(sorted(config["fit_params"].items()))
+        groups.setdefault(key, []).append((tree_params, config))
+
+    for group in groups.values():
+        tree_params, config = group[0]
+        if _hc_cut is None:
+            # Without the private cut, fall back to one fit per candidate
+            for tree_params, config in group:
+                clustering_model = AgglomerativeClustering(**config["hparams"]).fit(data_scaled, **config["fit_params"])
+                yield config, clustering_model, clustering_model.labels_
+            continue
+
+        # The full tree with merge distances, built once
+        tree = AgglomerativeClustering(**tree_params, n_clusters=None, distance_threshold=0.0, compute_full_tree=True)
+        tree.fit(data_scaled, **config["fit_params"])
+
+        for tree_params, config in group:
+            clustering_model = AgglomerativeClustering(**config["hparams"])
+            if clustering_model.distance_threshold is not None:
+                n_clusters = np.count_nonzero(tree.distances_ >= clustering_model.distance_threshold) + 1
+            else:
+                n_clusters = clustering_model.n_clusters
+            labels = _hc_cut(n_clusters, tree.children_, tree.n_leaves_)
+
+            # Hand back a model that looks like an ordinary fit on the features
+            clustering_model.n_clusters_ = n_clusters
+            clustering_model.labels_ = labels
+            clustering_model.children_ = tree.children_
+            clustering_model.distances_ = tree.distances_
+            clustering_model.n_leaves_ = tree.n_leaves_
+            clustering_model.n_connected_components_ = tree.n_connected_components_
+            clustering_model.n_features_in_ = tree.n_features_in_
+            yield config, clustering_model, labels
+
+def squared_distances(features, squared_norms, centers, chunk_rows=65536):
+    # Squared distance of every row to its closest center, from the shared row norms
+    closest = np.empty(len(features))
+    center_norms = row_norms(centers, squared=True)
+    for start in range(0, len(features), chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        distances = squared_norms[rows, None] - 2 * features[rows] @ centers.T + center_norms
+        closest[rows] = np.maximum(distances.min(axis=1), 0)
+    return closest
+
+def add_centers(features, squared_norms, centers, n_new, rng):
+    # k-means++ seeding of the extra centers, conditioned on the centers already there
+    closest = squared_distances(features, squared_norms, centers)
+    n_trials = 2 + int(np.log(len(centers) + n_new))
+    new_centers = []
+    for i in range(n_new):
+        if closest.sum() == 0:
+            candidates = rng.integers(len(features), size=n_trials)
+        else:
+            candidates = np.searchsorted(np.cumsum(closest), rng.random(n_trials) * closest.sum())
+            candidates = np.minimum(candidates, len(features) - 1)
+        # Greedy pick of the trial that lowers the potential the most
+        trials = [np.minimum(closest, squared_distances(features, squared_norms, features[[c]])) for c in candidates]
+        best = int(np.argmin([trial.sum() for trial in trials]))
+        closest = trials[best]
+        new_centers.append(features[candidates[best]])
+    return np.vstack([centers] + new_centers)
+
+def kmeans_sweep(configs, data_scaled):
+    # Configs that differ only in n_clusters are fitted in increasing k, each seeded with the previous centroids
+    groups = {}
+    for config in configs:
+        shared_params = {k: v for k, v in config["hparams"].items() if k != "n_clusters"}
+        key = str(sorted(shared_params.items())) + str(sorted(config["fit_params"].items()))
+        groups.setdefault(key, []).append(config)
+
+    # Shared by every fit of every group
+    features = np.asarray(data_scaled)
+    squared_norms = row_norms(features, squared=True)
+
+    for group in groups.values():
+        by_k = {}
+        for config in group:
+            by_k.setdefault(KMeans(**config["hparams"]).n_clusters, []).append(config)
+        # Optional elbow stop: "sweep": {"warm_start": true, "min_gain": 0.02, "patience": 2} in the grid entry
+        sweep_params = group[0].get("sweep", {})
+        min_gain, patience = sweep_params.get("min_gain"), sweep_params.get("patience", 1)
+        rng = np.random.default_rng(KMeans(**group[0]["hparams"]).random_state)
+
+        centers, inertia, flat, stopped = None, None, 0, False
+        for k in sorted(by_k):
+            if stopped:
+                # Past the elbow, left unfitted
+                for config in by_k[k]:
+                    yield config, None, None
+                continue
+
+            if centers is None or k <= len(centers):
+                clustering_model = KMeans(**by_k[k][0]["hparams"])
+            else:
+                init = add_centers(features, squared_norms, centers, k - len(centers), rng)
+                clustering_model = KMeans(**dict(by_k[k][0]["hparams"], init=init, n_init=1))
+            clustering_model.fit(features, **by_k[k][0]["fit_params"])
+            labels = clustering_model.labels_
+
+            if min_gain is not None and inertia is not None:
+                flat = flat + 1 if (inertia - clustering_model.inertia_) / inertia < min_gain else 0
+                stopped = flat >= patience
+            centers, inertia = clustering_model.cluster_centers_, clustering_model.inertia_
+            for config in by_k[k]:
+                yield config, clustering_model, labels
+
+# Sweeps whose fits differ from independent ones, only used when the grid entry sets "sweep": {"warm_start": true}
+WARM_SWEEPS = {"sklearn.cluster.KMeans"}
+
+SWEEPS = {
+    "sklearn.cluster.DBSCAN": dbscan_sweep,
+    "sklearn.cluster.AgglomerativeClustering": agglomerative_sweep,
+    "sklearn.cluster.KMeans": kmeans_sweep,
+}
@@ -1,68 +1,237 @@
 import os
 import argparse
 import importlib
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
-from utils import load_json, save_as_pickle
+from utils import load_json, dump_json, save_as_pickle, file_hash, dataset_hash, read_dataset, load_scaling, save_labels, stage
 
-def cluster_data(config_path, scaling_option, input_csv, output_dir):
-
-    config = load_json(config_path)
+def load_class(class_name):
     # Dynamically import clustering class
-    module_name, class_name = config["class_name"].rsplit('.', 1)
+    module_name, class_name = class_name.rsplit('.', 1)
     module = importlib.import_module(module_name)
-    clustering_class = getattr(module, class_name)
-
-    # Load clustering parameters and fit parameters
-    clustering_params = config["hparams"]
-    fit_params = config["fit_params"]
+    return getattr(module, class_name)
 
-    # Load and preprocess your data (assuming data is loaded as DataFrame)
-    data = pd.read_csv(input_csv)
+def load_data(input_csv):
+    # Load and preprocess your data (assuming data is loaded as DataFrame), parsed once and cached with compact dtypes
+    data = read_dataset(input_csv)
 
     # Raise error if the column 'Cluster' exist
     if "Cluster" in data.columns:
         raise ValueError("The column 'Cluster' is found in the csv file, please rename or remove the column")
+    return data
 
-    # Apply scaling if specified
+def read_chunks(input_csv, chunk_rows):
+    # Streaming counterpart of load_data, never more than chunk_rows rows in memory
+    for chunk in pd.read_csv(input_csv, chunksize=chunk_rows):
+        if "Cluster" in chunk.columns:
+            raise ValueError("The column 'Cluster' is found in the csv file, please rename or remove the column")
+        yield chunk
+
+def make_scaler(scaling_option):
     if scaling_option == 'standard':
-        scaler = StandardScaler()
-        data_scaled = scaler.fit_transform(data)
-        save_as_pickle(scaler, output_dir + '/scaler.pkl')
+        return StandardScaler()
     elif scaling_option == 'minmax':
-        scaler = MinMaxScaler()
+        return MinMaxScaler()
+    return None
+
+def scale_data(data, scaling_option):
+    # Apply scaling if specified
+    scaler = make_scaler(scaling_option)
+    if scaler is not None:
         data_scaled = scaler.fit_transform(data)
-        save_as_pickle(scaler, output_dir + '/scaler.pkl')
     else:
-        data_scaled = data
+        data_scaled = data.to_numpy()
+    return scaler, data_scaled
+
+def scaling_entry(input_csv, scaling_option, cache_dir, data_hash=None):
+    if data_hash is None:
+        data_hash = dataset_hash(input_csv)
+    return os.path.join(cache_dir, f"{data_hash}-{scaling_option}")
+
+def cache_scaling(input_csv, scaling_option, cache_dir, data=None, data_hash=None, timer=None, chunk_rows=None):
+    # The scaled matrix only depends on the dataset content and the scaling option
+    if data_hash is None and chunk_rows:
+        # Hashed while streaming, the columnar cache would parse the whole file in memory
+        data_hash = file_hash(input_csv)
+    entry_dir = scaling_entry(input_csv, scaling_option, cache_dir, data_hash)
+    features_path = os.path.join(entry_dir, "features.npy")
+    if os.path.exists(features_path):
+        return entry_dir
+
+    if not os.path.exists(entry_dir):
+        os.makedirs(entry_dir, exist_ok=True)
+    if chunk_rows:
+        with stage(timer, f"scale_{scaling_option}"):
+            stream_scaling(input_csv, scaling_option, entry_dir, chunk_rows)
+        return entry_dir
+    if data is None:
+        with stage(timer, "load"):
+            data = load_data(input_csv)
+    with stage(timer, f"scale_{scaling_option}"):
+        scaler, data_scaled = scale_data(data, scaling_option)
+        write_scaling(entry_dir, scaler, data_scaled, data.columns)
+    return entry_dir
+
+def write_scaling(entry_dir, scaler, data_scaled, columns):
+    # Write to temporary names first so a concurrent sweep never sees a partial entry
+    features_path = os.path.join(entry_dir, "features.npy")
+    tmp_suffix = f".{os.getpid()}.tmp"
+    if scaler is not None:
+        save_as_pickle(scaler, os.path.join(entry_dir, "scaler.pkl") + tmp_suffix)
+        os.replace(os.path.join(entry_dir, "scaler.pkl") + tmp_suffix, os.path.join(entry_dir, "scaler.pkl"))
+    dump_json(list(columns), os.path.join(entry_dir, "columns.json"))
+    with open(features_path + tmp_suffix, 'wb') as file:
+        np.save(file, np.ascontiguousarray(data_scaled, dtype=np.float32))
+    os.replace(features_path + tmp_suffix, features_path)
+
+def stream_scaling(input_csv, scaling_option, entry_dir, chunk_rows):
+    # First pass fits the scaler chunk by chunk, the second writes scaled chunks into a memory-mapped features.npy
+    scaler = make_scaler(scaling_option)
+    n_rows, columns = 0, None
+    for chunk in read_chunks(input_csv, chunk_rows):
+        if scaler is not None:
+            scaler.partial_fit(chunk)
+        n_rows += len(chunk)
+        columns = list(chunk.columns)
+
+    features_path = os.path.join(entry_dir, "features.npy")
+    tmp_suffix = f".{os.getpid()}.tmp"
+    if scaler is not None:
+        save_as_pickle(scaler, os.path.join(entry_dir, "scaler.pkl") + tmp_suffix)
+        os.replace(os.path.join(entry_dir, "scaler.pkl") + tmp_suffix, os.path.join(entry_dir, "scaler.pkl"))
+    dump_json(columns, os.path.join(entry_dir, "columns.json"))
+    features = np.lib.format.open_memmap(features_path + tmp_suffix, mode='w+', dtype=np.float32, shape=(n_rows, len(columns)))
+    start = 0
+    for chunk in read_chunks(input_csv, chunk_rows):
+        features[start:start + len(chunk)] = scaler.transform(chunk) if scaler is not None else chunk.to_numpy()
+        start += len(chunk)
+    features.flush()
+    del features
+    os.replace(features_path + tmp_suffix, features_path)
+
+def link_scaling(entry_dir, output_dir):
+    # Candidate folders point at the cache entry instead of holding their own scaler
+    dump_json({"entry": os.path.relpath(entry_dir, output_dir)}, os.path.join(output_dir, "scaling.json"))
+
+def fit_labels(config, data_scaled, timer=None):
+    clustering_class = load_class(config["class_name"])
+
+    # Load clustering parameters and fit parameters
+    clustering_params = config["hparams"]
+    fit_params = config["fit_params"]
 
     # Instantiate clustering model with parameters
     clustering_model = clustering_class(**clustering_params)
 
     # Fit the clustering model
-    clustering_model.fit(data_scaled, **fit_params)
+    with stage(timer, "fit"):
+        clustering_model.fit(data_scaled, **fit_params)
 
     # Predict clusters
-    try:
-        cluster_labels = clustering_model.predict(data_scaled)
-    except:
+    with stage(timer, "labels"):
         try:
-            cluster_labels = clustering_model.labels_
-        except:
-            clustering_model = clustering_class(**clustering_params)
-            cluster_labels = clustering_model.fit_predict(data_scaled)
+            cluster_labels = clustering_model.predict(data_scaled)
+        except AttributeError:
+            try:
+                cluster_labels = clustering_model.labels_
+            except AttributeError:
+                clustering_model = clustering_class(**clustering_params)
+                cluster_labels = clustering_model.fit_predict(data_scaled)
+    return clustering_model, cluster_labels
+
+def fit_streaming(config, data_scaled, chunk_rows, epochs=1, timer=None):
+    # Incremental estimators (MiniBatchKMeans, Birch, ...) see one chunk of rows at a time
+    clustering_class = load_class(config["class_name"])
+    clustering_model = clustering_class(**config["hparams"])
+    if not hasattr(clustering_model, "partial_fit"):
+        raise ValueError(f"{config['class_name']} has no partial_fit, streaming needs an incremental estimator such as MiniBatchKMeans or Birch")
+    with stage(timer, "fit"):
+        for epoch in range(epochs):
+            for start in range(0, len(data_scaled), chunk_rows):
+                clustering_model.partial_fit(np.asarray(data_scaled[start:start + chunk_rows]), **config["fit_params"])
+    return clustering_model
+
+def stream_labels(clustering_model, data_scaled, chunk_rows, output_dir, timer=None):
+    # Second pass assigns every chunk and writes straight into a memory-mapped labels.npy
+    labels_path = os.path.join(output_dir, "labels.npy")
+    tmp_suffix = f".{os.getpid()}.tmp"
+    # partial_fit leaves the inertia of the last chunk only, the real one is summed over this pass
+    centers = getattr(clustering_model, "cluster_centers_", None) if hasattr(clustering_model, "inertia_") else None
+    inertia = 0.0
+    with stage(timer, "labels"):
+        cluster_labels = np.lib.format.open_memmap(labels_path + tmp_suffix, mode='w+', dtype=np.int32, shape=(len(data_scaled),))
+        for start in range(0, len(data_scaled), chunk_rows):
+            chunk = np.asarray(data_scaled[start:start + chunk_rows])
+            chunk_labels = clustering_model.predict(chunk)
+            cluster_labels[start:start + chunk_rows] = chunk_labels
+            if centers is not None:
+                residuals = chunk - centers[chunk_labels]
+                inertia += float(np.einsum('ij,ij->', residuals, residuals))
+        cluster_labels.flush()
+        del cluster_labels
+        os.replace(labels_path + tmp_suffix, labels_path)
+    cluster_labels = np.load(labels_path, mmap_mode='r')
+    if centers is not None:
+        clustering_model.inertia_ = inertia
+    # Same for labels_, the pickled model gets the labels of every row
+    if hasattr(clustering_model, "labels_"):
+        clustering_model.labels_ = np.asarray(cluster_labels)
+    return cluster_labels
+
+def cluster_streaming(config, data_scaled, output_dir, chunk_rows, epochs=1, timer=None):
+    # Out-of-core counterpart of cluster_scaled, memory is bounded by chunk_rows instead of the dataset
+    clustering_model = fit_streaming(config, data_scaled, chunk_rows, epochs, timer)
+    cluster_labels = stream_labels(clustering_model, data_scaled, chunk_rows, output_dir, timer)
+    save_as_pickle(clustering_model, output_dir + '/clustering_model.pkl')
+    print("Clustering completed. Cluster labels saved to 'labels.npy'.")
+    return cluster_labels, clustering_model
+
+def cluster_scaled(config, data_scaled, columns, output_dir, fitted=None, timer=None):
+    # A sweep may already have fitted the model on these features
+    if fitted is None:
+        clustering_model, cluster_labels = fit_labels(config, data_scaled, timer)
+    else:
+        clustering_model, cluster_labels = fitted
 
     # Turn data_scaled into pandas dataframe
-    data_scaled = pd.DataFrame(data_scaled, columns=data.columns)
+    data_scaled = pd.DataFrame(data_scaled, columns=columns)
 
-    # Save cluster labels and data to CSV
-    data_with_clusters = pd.concat([data_scaled, pd.DataFrame({'Cluster': cluster_labels})], axis=1)
-    data_with_clusters.to_csv(output_dir + '/data_with_clusters.csv', index=False)
+    # Save only the cluster labels, the features stay in the scaling entry
+    save_labels(cluster_labels, output_dir)
 
     # Save clustering model
     save_as_pickle(clustering_model, output_dir + '/clustering_model.pkl')
 
-    print("Clustering completed. Clustered data saved to 'data_with_clusters.csv'.")
+    print("Clustering completed. Cluster labels saved to 'labels.npy'.")
+    return data_scaled, cluster_labels, clustering_model
+
+def cluster_dataframe(config, scaling_option, data, output_dir):
+    # Without a cache the output folder is its own scaling entry
+    scaler, data_scaled = scale_data(data, scaling_option)
+    write_scaling(output_dir, scaler, data_scaled, data.columns)
+    link_scaling(output_dir, output_dir)
+    return cluster_scaled(config, data_scaled, data.columns, output_dir)
+
+def cluster_data(config_path, scaling_option, input_csv, output_dir, cache_dir=None, chunk_rows=None, epochs=1):
+    config = load_json(config_path)
+    if chunk_rows:
+        # Without a cache the output folder is its own scaling entry
+        entry_dir = output_dir if cache_dir is None else cache_scaling(input_csv, scaling_option, cache_dir, chunk_rows=chunk_rows)
+        if cache_dir is None:
+            stream_scaling(input_csv, scaling_option, output_dir, chunk_rows)
+        link_scaling(entry_dir, output_dir)
+        data_scaled, columns, scaler = load_scaling(entry_dir)
+        return cluster_streaming(config, data_scaled, output_dir, chunk_rows, epochs)
+
+    if cache_dir is None:
+        data = load_data(input_csv)
+        return cluster_dataframe(config, scaling_option, data, output_dir)
+
+    entry_dir = cache_scaling(input_csv, scaling_option, cache_dir)
+    link_scaling(entry_dir, output_dir)
+    data_scaled, columns, scaler = load_scaling(entry_dir)
+    return cluster_scaled(config, data_scaled, columns, output_dir)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Perform data clustering.')
@@ -70,9 +239,12 @@ if __name__ == "__main__":
     parser.add_argument('--scaling_option', type=str, help='Scaling option (standard, minmax, none)')
     parser.add_argument('--input_csv', type=str, help='Path to input CSV file')
     parser.add_argument('--output_dir', type=str, help='Output directory for saving results')
+    parser.add_argument('--cache_dir', type=str, help='Scaling cache directory, when set the scaled data is reused across runs instead of refitted', default=None)
+    parser.add_argument('--chunk_rows', type=int, help='Stream the CSV in chunks of this many rows (partial_fit scaler and estimator, chunked labels) instead of loading it whole', default=None)
+    parser.add_argument('--epochs', type=int, help='Passes over the data when streaming', default=1)
     args = parser.parse_args()
 
     if not os.path.exists(args.output_dir):
         os.makedirs(args.output_dir)
 
-    cluster_data(args.config_path, args.scaling_option, args.input_csv, args.output_dir)
+    cluster_data(args.config_path, args.scaling_option, args.input_csv, args.output_dir, args.cache_dir, args.chunk_rows, args.epochs)
@@ -1,6 +1,13 @@
+import os
+import io
+import re
 import json
+import time
+import hashlib
 import pickle
+from contextlib import contextmanager, nullcontext
 import numpy as np
+import pandas as pd
 
 def load_json(json_path):
     with open(json_path, 'r') as file:
@@ -39,4 +46,240 @@ def overall_metrics(metrics):
         result = (scaled_silhouette + scaled_db_index + scaled_ch_index) / 3
     else:
         result = (scaled_silhouette + scaled_db_index) / 2
-    return result
\ No newline at end of file
+    return result
+
+def failed_score(status):
+    # No fake scores for candidates that did not finish or cannot be scored, they just never rank
+    return {
+        "Silhouette Score": np.nan,
+        "Davies-Bouldin Index": np.nan,
+        "Calinski-Harabasz Index": np.nan,
+        "Status": status
+    }
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def columnar_dir(csv_path):
+    return os.path.join(os.path.dirname(os.path.abspath(csv_path)), ".columnar", os.path.basename(csv_path))
+
+def compact_column(values):
+    # Smallest dtype that holds every value exactly
+    if values.dtype.kind in "iu":
+        return pd.to_numeric(values, downcast="integer") if len(values) else values
+    if values.dtype.kind == "f":
+        narrow = values.astype(np.float32)
+        if np.array_equal(narrow.astype(values.dtype), values, equal_nan=True):
+            return narrow
+    return values
+
+def ingest_csv(csv_path):
+    # Parse the CSV once, hashing the same bytes, and keep one .npy per column
+    with open(csv_path, 'rb') as file:
+        raw = file.read()
+    stat = os.stat(csv_path)
+    data = pd.read_csv(io.BytesIO(raw))
+    meta = {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "hash": hashlib.sha1(raw).hexdigest(),
+        "columns": list(data.columns),
+        "dtypes": {}
+    }
+    del raw
+
+    # Temporary names first, concurrent workers may ingest the same file
+    cache_dir = columnar_dir(csv_path)
+    tmp_suffix = f".{os.getpid()}.tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        for i, column in enumerate(data.columns):
+            values = compact_column(data[column].to_numpy())
+            meta["dtypes"][column] = str(values.dtype)
+            if values.dtype == object:
+                continue
+            column_path = os.path.join(cache_dir, f"{i}.npy")
+            with open(column_path + tmp_suffix, 'wb') as file:
+                np.save(file, values, allow_pickle=False)
+            os.replace(column_path + tmp_suffix, column_path)
+        # meta.json is written last, it marks the cache as complete
+        meta_path = os.path.join(cache_dir, "meta.json")
+        dump_json(meta, meta_path + tmp_suffix)
+        os.replace(meta_path + tmp_suffix, meta_path)
+    except OSError as e:
+        # Read-only data folder, the parsed frame is still good for this call
+        print("Columnar cache not written:", e)
+    return meta, data
+
+def dataset_meta(csv_path):
+    # Cached metadata, or None once the source changed since it was parsed
+    meta_path = os.path.join(columnar_dir(csv_path), "meta.json")
+    if not os.path.exists(meta_path):
+        return None
+    meta = load_json(meta_path)
+    stat = os.stat(csv_path)
+    if meta["size"] != stat.st_size or meta["mtime_ns"] != stat.st_mtime_ns:
+        return None
+    return meta
+
+def dataset_hash(csv_path):
+    # Same digest as file_hash, without rereading a source that is already cached
+    meta = dataset_meta(csv_path)
+    if meta is None:
+        meta, data = ingest_csv(csv_path)
+    return meta["hash"]
+
+def dataset_columns(csv_path):
+    meta = dataset_meta(csv_path)
+    if meta is None:
+        meta, data = ingest_csv(csv_path)
+    return meta["columns"]
+
+def read_dataset(csv_path, columns=None, float32=False):
+    # Drop-in for pd.read_csv: compact dtypes, only the requested columns, parsed text only on first use
+    meta = dataset_meta(csv_path)
+    data = None
+    if meta is None:
+        meta, data = ingest_csv(csv_path)
+    columns = meta["columns"] if columns is None else list(columns)
+    missing = [column for column in columns if column not in meta["columns"]]
+    if missing:
+        raise KeyError(f"{missing} not in {csv_path}")
+
+    result = {}
+    for column in columns:
+        if data is not None or meta["dtypes"][column] == "object":
+            # Text columns are not cached, they come from the CSV
+            data = pd.read_csv(csv_path) if data is None else data
+            values = compact_column(data[column].to_numpy())
+        else:
+            values = np.load(os.path.join(columnar_dir(csv_path), f"{meta['columns'].index(column)}.npy"))
+        if float32 and values.dtype.kind == "f":
+            values = values.astype(np.float32, copy=False)
+        result[column] = values
+    return pd.DataFrame(result, columns=columns)
+
+def load_scaling(entry_dir, mmap_mode='r'):
+    data_scaled = np.load(os.path.join(entry_dir, "features.npy"), mmap_mode=mmap_mode)
+    columns = load_json(os.path.join(entry_dir, "columns.json"))
+    scaler_path = os.path.join(entry_dir, "scaler.pkl")
+    scaler = load_pickle(scaler_path) if os.path.exists(scaler_path) else None
+    return data_scaled, columns, scaler
+
+def save_labels(cluster_labels, run_dir):
+    np.save(os.path.join(run_dir, "labels.npy"), np.asarray(cluster_labels, dtype=np.int32))
+
+def load_labels(run_dir):
+    return np.load(os.path.join(run_dir, "labels.npy"))
+
+def run_entry(run_dir):
+    return os.path.normpath(os.path.join(run_dir, load_json(os.path.join(run_dir, "scaling.json"))["entry"]))
+
+def load_run(run_dir, mmap_mode='r'):
+    # Features come from the scaling entry the run points at, labels from the run itself
+    data_scaled, columns, scaler = load_scaling(run_entry(run_dir), mmap_mode)
+    return data_scaled, columns, load_labels(run_dir)
+
+def reset_peak_rss():
+    # Linux lets a process reset its own high-water mark, elsewhere the peak stays process-wide
+    try:
+        with open("/proc/self/clear_refs", 'w') as file:
+            file.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status", 'r') as file:
+            return int(re.search(r"VmHWM:\s+(\d+)", file.read()).group(1)) / 1024
+    except (OSError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def process_peak_mb(pid):
+    # High-water mark of another process since its last exec, 0 once it is gone
+    try:
+        with open(f"/proc/{pid}/status", 'r') as file:
+            return int(re.search(r"VmHWM:\s+(\d+)", file.read()).group(1)) / 1024
+    except (OSError, AttributeError):
+        return 0.0
+
+def process_tree_usage(pid):
+    # Resident memory (MB) and CPU seconds of a process and all of its descendants, read from /proc (zeros without it)
+    try:
+        tick, page = os.sysconf("SC_CLK_TCK"), os.sysconf("SC_PAGE_SIZE")
+        entries = os.listdir("/proc")
+    except (OSError, ValueError, AttributeError):
+        return 0.0, 0.0
+    stats = {}
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", 'r') as file:
+                fields = file.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        stats[int(entry)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / tick, int(fields[21]) * page / 1024 ** 2)
+
+    children = {}
+    for child, (parent, _, _) in stats.items():
+        children.setdefault(parent, []).append(child)
+    tree, rss, cpu = [pid], 0.0, 0.0
+    while tree:
+        member = tree.pop()
+        if member in stats:
+            cpu += stats[member][1]
+            rss += stats[member][2]
+        tree.extend(children.get(member, []))
+    return rss, cpu
+
+# Running peak of every stage still open in this process, nested stages fold it in before resetting the high-water mark
+_open_peaks = []
+
+def fold_peak_rss():
+    peak = peak_rss_mb()
+    for running in _open_peaks:
+        running[0] = max(running[0], peak)
+
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    def record(self, name, wall, cpu, peak_rss_mb):
+        # For work measured elsewhere, e.g. a subprocess
+        self.stages[name] = {
+            "wall": wall,
+            "cpu": cpu,
+            "peak_rss_mb": peak_rss_mb
+        }
+
+    @contextmanager
+    def stage(self, name):
+        fold_peak_rss()
+        reset_peak_rss()
+        running = [0.0]
+        _open_peaks.append(running)
+        cpu = time.process_time()
+        wall = time.perf_counter()
+        try:
+            yield
+        finally:
+            fold_peak_rss()
+            _open_peaks[:] = [r for r in _open_peaks if r is not running]
+            self.record(name, time.perf_counter() - wall, time.process_time() - cpu, running[0])
+
+def timing_columns(stages):
+    # Flat summary columns: wall time per stage, plus totals and the overall peak
+    columns = {f"time_{name}": stage["wall"] for name, stage in stages.items()}
+    columns["time_total"] = sum(stage["wall"] for stage in stages.values())
+    columns["cpu_total"] = sum(stage["cpu"] for stage in stages.values())
+    columns["peak_rss_mb"] = max((stage["peak_rss_mb"] for stage in stages.values()), default=0)
+    return columns
+
+def stage(timer, name):
+    return timer.stage(name) if timer is not None else nullcontext()
@@ -1,58 +1,106 @@
 import os
-import shutil
+import sys
 import csv
-from flask import Flask, render_template
+import math
+from flask import Flask, render_template, send_from_directory, abort
 import argparse
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from results import STORE, load_results, score_results
+
 app = Flask(__name__)
 
-# # Load data from CSV
-# data = []
-# with open('../../out/out_450/summary_score.csv', 'r') as csvfile:
-#     csvreader = csv.DictReader(csvfile)
-#     for row in csvreader:
-#         data.append(row)
+# Result directories given on the command line, either sweep outputs or folders holding several of them
+roots = []
+
+# Sorted per-metric indexes, rebuilt when the results store (or summary_score.csv) changes
+indexes = {}
+
+def summary_file(directory):
+    # The store is appended to while a sweep runs, summary_score.csv only appears at its end
+    for file_name in (STORE, "summary_score.csv"):
+        if os.path.exists(os.path.join(directory, file_name)):
+            return os.path.join(directory, file_name)
+    return None
+
+def result_sets():
+    # Discovered on every call so new sweeps show up without a restart
+    found = {}
+    for root in roots:
+        if summary_file(root):
+            candidates = [root]
+        elif os.path.isdir(root):
+            candidates = sorted(os.path.join(root, d) for d in os.listdir(root))
+        else:
+            candidates = []
+        for directory in candidates:
+            if os.path.isdir(directory) and summary_file(directory):
+                name = os.path.basename(os.path.normpath(directory))
+                while name in found:
+                    name = name + "_"
+                found[name] = directory
+    return found
+
+def score_index(directory, score_type):
+    summary_path = summary_file(directory)
+    mtime = os.stat(summary_path).st_mtime_ns
+    entry = indexes.get(directory)
+    if entry is None or entry["path"] != summary_path or entry["mtime"] != mtime:
+        if summary_path.endswith(STORE):
+            rows = score_results(load_results(directory)).to_dict("records")
+        else:
+            with open(summary_path, 'r') as csvfile:
+                rows = list(csv.DictReader(csvfile))
+        entry = {"path": summary_path, "mtime": mtime, "rows": rows, "sorted": {}}
+        indexes[directory] = entry
+
+    if score_type not in entry["sorted"]:
+        if entry["rows"] and score_type not in entry["rows"][0]:
+            return None
+        score_names = [(row["Name"], float(row[score_type])) for row in entry["rows"] if row[score_type] != ""]
+        score_names = [el for el in score_names if not math.isnan(el[1])]
+        score_names = sorted(score_names, key=lambda x: x[1])
+        entry["sorted"][score_type] = ([el[1] for el in score_names], [el[0] for el in score_names])
+    return entry["sorted"][score_type]
 
 @app.route('/')
 def index():
-    return render_template('index.html')
+    return render_template('index.html', result_sets=list(result_sets()))
 
 @app.route('/score/<score_type>')
 def score(score_type):
-    score_names = [(row["Name"], float(row[score_type])) for row in data]
-    score_names = sorted(score_names, key=lambda x: x[1])
-    scores = [el[1] for el in score_names]
-    names = [el[0] for el in score_names]
-    image_url = f"/static/images/{score_names[0][0]}/scatter.jpg"
+    # Kept for old links, shows the first result set
+    sets = result_sets()
+    if not sets:
+        abort(404)
+    return result_score(next(iter(sets)), score_type)
 
-    return render_template('score.html', score_type=score_type, image_url=image_url, scores=scores, names=names, length=len(score_names))
+@app.route('/<result_set>/score/<score_type>')
+def result_score(result_set, score_type):
+    directory = result_sets().get(result_set)
+    if directory is None:
+        abort(404)
+    index = score_index(directory, score_type)
+    if not index or not index[0]:
+        abort(404)
+    scores, names = index
+    image_url = f"/{result_set}/runs/{names[0]}/scatter.jpg"
+
+    return render_template('score.html', result_set=result_set, score_type=score_type, image_url=image_url, scores=scores, names=names, length=len(names))
+
+@app.route('/<result_set>/runs/<name>/scatter.jpg')
+def scatter(result_set, name):
+    # Served straight from the results, with ETag and Last-Modified for browser caching
+    directory = result_sets().get(result_set)
+    if directory is None:
+        abort(404)
+    return send_from_directory(os.path.join(directory, name), "scatter.jpg", conditional=True)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Visualization evaluation')
-    parser.add_argument('--dir', type=str, help='Path to directory consist of all models created', default='../../out/out_450')
+    parser.add_argument('--dir', type=str, nargs='+', help='Directories of models created (or folders holding several of them, e.g. out/iter2)', default=['../../out/out_450'])
     args = parser.parse_args()
 
-    data = []
-
-    if not os.path.exists("./static"):
-        os.makedirs("./static")
-    else:
-        shutil.rmtree("./static")
-        os.makedirs("./static")
-
-    shutil.copy(os.path.join(args.dir, "summary_score.csv"), "./static/summary_score.csv")
-
-    with open('./static/summary_score.csv', 'r') as csvfile:
-        csvreader = csv.DictReader(csvfile)
-        for row in csvreader:
-            data.append(row)
-    
-    names = [el for el in os.listdir(args.dir) if os.path.isdir(os.path.join(args.dir, el))]
-
-    for n in names:
-        folder = os.path.join("./static/images/", n)
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-        shutil.copy(os.path.join(args.dir, n, "scatter.jpg"), os.path.join(folder, "scatter.jpg"))
+    roots.extend(args.dir)
 
     app.run(debug=True)